@@ -1,21 +1,29 @@
 import os
+import asyncio
 import logging
 import time
 import json
 import re # Import re for parsing
 
+import diskcache
+
 import config
 import utils
-from rag_processor import RAGProcessor
+from rag_processor import RAGProcessor, get_rag_processor
 # Import the parser function correctly
-from llm_interface import generate_completion, parse_llm_response_to_json
+from llm_interface import agenerate_completion, astream_completion, aclose_async_clients, batch_generate_completions, JSONArrayStreamParser, parse_llm_response_to_json
+
+logger = logging.getLogger(__name__)
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# --- Finding Validation ---
+# Built once instead of per finding
+_REQUIRED_KEYS = frozenset(("line_number", "category", "description", "severity"))
+_ALLOWED_CATEGORIES = frozenset(cat.strip() for cat in config.TECH_DEBT_CATEGORIES.split(','))
 
 # --- Prompt Engineering ---
 
-def create_system_prompt():
-    """Creates the system prompt for the LLM."""
+def _build_system_prompt():
+    """Builds the system prompt for the LLM."""
     # Ensure TECH_DEBT_CATEGORIES is properly fetched from config
     categories = config.TECH_DEBT_CATEGORIES
     return f"""You are an AI assistant specialized in analyzing source code to identify technical debt.
@@ -56,160 +64,519 @@ If no technical debt is found in the snippet, return an empty JSON list: [].
 Do NOT include any explanations, introductory text, or markdown formatting like ```json before or after the JSON list itself. Just output the raw JSON list.
 """
 
-def create_user_prompt(code_snippet: str, relevant_norms: list[str]) -> str:
-    """Creates the user prompt for the LLM."""
-    norm_section = "No specific organizational norms provided for context."
-    if relevant_norms:
-        norm_section = "Consider these relevant organizational norms/guidelines:\n"
-        for i, norm in enumerate(relevant_norms):
-            # Ensure norms are clearly separated and formatted
-            norm_section += f"\n--- Norm {i+1} Start ---\n{norm}\n--- Norm {i+1} End ---\n"
-        norm_section += "\n--- End of Norms ---"
-
-    # Ensure the code snippet is clearly demarcated
-    return f"""{norm_section}
-Analyze the following code snippet for technical debt based on the categories and format instructions provided in the system prompt:
+# Built once and kept byte-identical across requests (no timestamps/ids) so providers can reuse the cached prefix
+SYSTEM_PROMPT = _build_system_prompt()
+
+# Static instructions first, then norms, then the code: the longest possible prefix is shared across files
+_USER_PROMPT_TEMPLATE = """Analyze the code snippet at the end of this message for technical debt based on the categories and format instructions provided in the system prompt.
+
+{norms}
 
 ```code
-{code_snippet}
+{code}
+```
 Remember to respond ONLY with the raw JSON list of findings, nothing else. """
 
-def analyze_code_file(repo_base_path: str, relative_file_path: str, rag_processor: RAGProcessor, llm_type: str) -> list:
-    """Analyzes a single code file for technical debt."""
-    logging.info(f"Analyzing file: {relative_file_path}")
-    code_content = utils.read_file_content(repo_base_path, relative_file_path)
-    if not code_content:
-        logging.warning(f"Skipping empty or unreadable file: {relative_file_path}")
-        return []
+_BATCH_USER_PROMPT_TEMPLATE = """Analyze each of the files at the end of this message for technical debt based on the categories and format instructions provided in the system prompt.
 
-    # --- RAG Step ---
-    # Use file content (or potentially chunks/summaries for large files) to find relevant norms
-    # TODO: Add check for file size and implement chunking if needed
-    relevant_norms = rag_processor.retrieve_relevant_norms(code_content)
-    logging.debug(f"Retrieved {len(relevant_norms)} norms for {relative_file_path}")
+{norms}
 
-    # --- LLM Step ---
-    # TODO: Implement chunking for files exceeding context window limits.
-    system_prompt = create_system_prompt()
-    user_prompt = create_user_prompt(code_content, relevant_norms)
+{files}
+--- END OF FILES ---
+Remember to respond ONLY with the raw JSON object keyed by file path, nothing else. """
 
-    llm_response_text = generate_completion(llm_type, user_prompt, system_prompt)
+def _format_norm_section(relevant_norms: list[str]) -> str:
+    """Formats retrieved norms as clearly separated blocks (joined once, no repeated concatenation)."""
+    if not relevant_norms:
+        return "No specific organizational norms provided for context."
+    parts = ["Consider these relevant organizational norms/guidelines:\n"]
+    parts.extend(f"\n--- Norm {i+1} Start ---\n{norm}\n--- Norm {i+1} End ---\n" for i, norm in enumerate(relevant_norms))
+    parts.append("\n--- End of Norms ---")
+    return "".join(parts)
 
-    if not llm_response_text:
-        logging.error(f"Failed to get LLM response for file: {relative_file_path}")
-        return [] # Return empty list for this file on failure
+def create_user_prompt(code_snippet: str, relevant_norms: list[str]) -> str:
+    """Creates the user prompt for the LLM."""
+    return _USER_PROMPT_TEMPLATE.format(norms=_format_norm_section(relevant_norms), code=code_snippet)
 
-    # --- Parsing Step ---
-    # Use the dedicated parser function from llm_interface
-    parsed_findings = parse_llm_response_to_json(llm_response_text)
+def _build_batch_system_prompt():
+    """Builds the system prompt for analyzing several small files in a single LLM request."""
+    categories = config.TECH_DEBT_CATEGORIES
+    return f"""You are an AI assistant specialized in analyzing source code to identify technical debt.
+Your goal is to find potential issues related to the following categories: {categories}.
 
-    if parsed_findings is None:
-        logging.error(f"Failed to parse LLM response into JSON for file: {relative_file_path}. Response snippet: {llm_response_text[:200]}...")
-        return [] # Return empty list if parsing fails
+You will be given SEVERAL files, each introduced by a line of the form `--- FILE: <path> ---`, and potentially relevant excerpts from the organization's coding standards and architectural norms.
 
-    # Ensure the result is a list, even if the LLM mistakenly returned a single object
-    if isinstance(parsed_findings, dict):
-        logging.warning(f"LLM response for {relative_file_path} was a single JSON object, expected list. Wrapping it in a list.")
-        parsed_findings = [parsed_findings]
-    elif not isinstance(parsed_findings, list):
-        logging.error(f"Parsed LLM response for {relative_file_path} is not a list or dict. Type: {type(parsed_findings)}. Response snippet: {llm_response_text[:200]}...")
-        return [] # Return empty list if the structure is unexpected
+Analyze each file separately and carefully.
+Consider the provided organizational norms. If the code violates any specific norm, mention it.
+Identify specific instances of technical debt within each file.
+For each instance found, provide:
+1.  `line_number`: The approximate starting line number of the issue, counted from the first line of its own file.
+2.  `category`: One of the predefined categories: {categories}.
+3.  `description`: A concise explanation of the technical debt and why it's an issue.
+4.  `severity`: Estimate the severity (e.g., Low, Medium, High).
+5.  `norm_violated`: (Optional) The specific organizational norm violated, if applicable.
 
-    # Add file context and validate each finding
+Format your response STRICTLY as a JSON object whose keys are the file paths exactly as given, each mapping to a JSON list of finding objects.
+Example:
+{{
+  "src/app.py": [
+    {{
+      "line_number": 15,
+      "category": "Readability",
+      "description": "Variable name 'x' is too generic. Consider a more descriptive name.",
+      "severity": "Low",
+      "norm_violated": "Variables should be descriptive (Section 3.2)"
+    }}
+  ],
+  "src/utils.py": []
+}}
+
+Every given file path must appear as a key. Use an empty list for files without technical debt.
+Do NOT include any explanations, introductory text, or markdown formatting like ```json before or after the JSON object itself. Just output the raw JSON object.
+"""
+
+BATCH_SYSTEM_PROMPT = _build_batch_system_prompt()
+
+# --- Findings Cache ---
+# Bump whenever prompt wording or the findings format changes, to invalidate previously cached findings
+PROMPT_VERSION = 1
+_PROMPT_HASH = utils.content_hash(SYSTEM_PROMPT + BATCH_SYSTEM_PROMPT)
+# Findings of unchanged files are reused across scans (e.g. CI re-scans of the same repo)
+_findings_cache = diskcache.Cache(config.FINDINGS_CACHE_DIR)
+
+def _findings_cache_key(code_content: str, relevant_norms: list[str], llm_type: str) -> tuple:
+    model_name = config.OPENAI_MODEL_NAME if llm_type == 'openai' else config.OLLAMA_MODEL_NAME
+    norms_hashes = tuple(sorted(utils.content_hash(norm) for norm in relevant_norms))
+    return (PROMPT_VERSION, _PROMPT_HASH, llm_type, model_name, utils.content_hash(code_content), norms_hashes)
+
+def _get_cached_findings(cache_key: tuple, relative_file_path: str) -> list | None:
+    """Returns cached findings re-labelled for this path, or None on a miss."""
+    cached = _findings_cache.get(cache_key)
+    if cached is None:
+        return None
+    return [{**finding, "file": relative_file_path, "from_cache": True} for finding in cached]
+
+def create_batch_user_prompt(files: list[tuple[str, str]], relevant_norms: list[str]) -> str:
+    """Creates the user prompt for a batch of (relative_path, code) pairs."""
+    file_section = "\n".join(f"--- FILE: {path} ---\n{code}" for path, code in files)
+    return _BATCH_USER_PROMPT_TEMPLATE.format(norms=_format_norm_section(relevant_norms), files=file_section)
+
+def _validate_findings(parsed_findings: list, relative_file_path: str) -> list:
+    """Adds file context to each parsed finding and drops malformed ones."""
     file_results = []
     for finding in parsed_findings:
         if isinstance(finding, dict):
             # Basic validation of expected keys (adjust as needed)
-            required_keys = ["line_number", "category", "description", "severity"]
-            if all(key in finding for key in required_keys):
+            if _REQUIRED_KEYS.issubset(finding):
                 finding['file'] = relative_file_path # Add file path context
                 # Ensure category is one of the allowed ones (optional strict check)
-                allowed_categories = [cat.strip() for cat in config.TECH_DEBT_CATEGORIES.split(',')]
-                if finding.get('category') not in allowed_categories:
-                    logging.warning(f"Finding in {relative_file_path} has invalid category '{finding.get('category')}'. Allowed: {allowed_categories}. Keeping it for now.")
+                if finding.get('category') not in _ALLOWED_CATEGORIES:
+                    logger.warning("Finding in %s has invalid category '%s'. Allowed: %s. Keeping it for now.", relative_file_path, finding.get('category'), sorted(_ALLOWED_CATEGORIES))
                     # Optionally: finding['category'] = 'Unknown' or skip the finding
                 file_results.append(finding)
             else:
-                logging.warning(f"Skipping malformed finding in {relative_file_path} (missing keys): {finding}")
+                logger.warning("Skipping malformed finding in %s (missing keys): %s", relative_file_path, finding)
         else:
-            logging.warning(f"Skipping non-dict item in parsed list for {relative_file_path}: {finding}")
+            logger.warning("Skipping non-dict item in parsed list for %s: %s", relative_file_path, finding)
+    return file_results
 
-    logging.info(f"Found {len(file_results)} potential tech debt items in {relative_file_path}")
+def _rag_query_samples(code_content: str) -> list[str]:
+    """
+    Returns the texts to query RAG with: the whole content for normal files, or the
+    head/middle/tail CHUNK_SIZE windows for files larger than CHUNK_SIZE*4.
+    """
+    if len(code_content) <= config.CHUNK_SIZE * 4:
+        return [code_content]
+    step = config.CHUNK_SIZE - config.CHUNK_OVERLAP
+    window_starts = range(0, len(code_content) - config.CHUNK_OVERLAP, step)
+    sampled_starts = dict.fromkeys((window_starts[0], window_starts[len(window_starts) // 2], window_starts[-1]))
+    return [code_content[start:start + config.CHUNK_SIZE] for start in sampled_starts]
+
+async def _read_file(repo_base_path: str, relative_file_path: str, max_bytes: int | None = None) -> str | None:
+    """Reads a file on the shared I/O pool so the event loop keeps driving LLM calls."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(utils.IO_EXECUTOR, utils.read_file_content, repo_base_path, relative_file_path, max_bytes)
+
+async def _prepare_file(repo_base_path: str, relative_file_path: str, rag_processor: RAGProcessor, llm_type: str) -> dict | list:
+    """
+    Reads a file and retrieves its norms.
+
+    Returns the findings list when there is nothing to ask the LLM (unreadable file or cache hit),
+    otherwise a dict with the user prompt, findings cache key, semantic cache key and truncation flag.
+    """
+    # Blocking file I/O and embedding work run in worker threads so other files' LLM calls keep flowing
+    # Oversized (e.g. generated) files are truncated so they cannot blow the LLM context
+    code_content = await _read_file(repo_base_path, relative_file_path, config.MAX_FILE_BYTES)
+    if not code_content:
+        logger.warning("Skipping empty or unreadable file: %s", relative_file_path)
+        return []
+    truncated = os.path.getsize(os.path.join(repo_base_path, relative_file_path)) > config.MAX_FILE_BYTES
+    if truncated:
+        logger.warning("File %s exceeds %s bytes. Analyzing only its beginning.", relative_file_path, config.MAX_FILE_BYTES)
+
+    # --- RAG Step ---
+    # Large files are represented by a few sampled chunks instead of being embedded whole
+    # Queries are issued concurrently so they land in the same embedding batch
+    sample_norms = await asyncio.gather(*(rag_processor.aretrieve_relevant_norms(query) for query in _rag_query_samples(code_content)))
+    relevant_norms = list(dict.fromkeys(norm for norms in sample_norms for norm in norms))
+    logger.debug("Retrieved %s norms for %s", len(relevant_norms), relative_file_path)
+
+    # --- Findings Cache Step ---
+    cache_key = _findings_cache_key(code_content, relevant_norms, llm_type)
+    cached_results = _get_cached_findings(cache_key, relative_file_path)
+    if cached_results is not None:
+        logger.info("Reusing %s cached findings for unchanged file: %s", len(cached_results), relative_file_path)
+        return cached_results
+
+    # Files over MAX_FILE_BYTES were truncated above rather than chunked; their findings are marked "truncated"
+    return {
+        "user_prompt": create_user_prompt(code_content, relevant_norms),
+        "cache_key": cache_key,
+        # Semantic LLM cache: similar code reuses a response only if the prompt's norms are identical
+        "semantic_key": (code_content, utils.content_hash("\n".join(relevant_norms))),
+        "truncated": truncated,
+    }
+
+def _parse_findings(llm_response_text: str, relative_file_path: str) -> list | None:
+    """Parses a complete single-file LLM response into validated findings, or None if it is not usable."""
+    parsed_findings = parse_llm_response_to_json(llm_response_text)
+
+    if parsed_findings is None:
+        logger.error("Failed to parse LLM response into JSON for file: %s. Response snippet: %.200s...", relative_file_path, llm_response_text)
+        return None
+
+    # Ensure the result is a list, even if the LLM mistakenly returned a single object
+    if isinstance(parsed_findings, dict):
+        logger.warning("LLM response for %s was a single JSON object, expected list. Wrapping it in a list.", relative_file_path)
+        parsed_findings = [parsed_findings]
+    elif not isinstance(parsed_findings, list):
+        logger.error("Parsed LLM response for %s is not a list or dict. Type: %s. Response snippet: %.200s...", relative_file_path, type(parsed_findings), llm_response_text)
+        return None
+
+    # Add file context and validate each finding
+    return _validate_findings(parsed_findings, relative_file_path)
+
+def _store_findings(prepared: dict, file_results: list, relative_file_path: str) -> list:
+    """Marks findings of truncated files and caches them."""
+    if prepared["truncated"]:
+        for finding in file_results:
+            finding["truncated"] = True
+
+    # Only successfully parsed responses reach this point, so an empty list is a real "no findings"
+    _findings_cache.set(prepared["cache_key"], file_results)
+    logger.info("Found %s potential tech debt items in %s", len(file_results), relative_file_path)
     return file_results
 
-def run_scan(job_id: str, repo_url: str, llm_type: str) -> dict:
+async def analyze_code_file(repo_base_path: str, relative_file_path: str, rag_processor: RAGProcessor, llm_type: str) -> list:
+    """Analyzes a single code file for technical debt."""
+    logger.info("Analyzing file: %s", relative_file_path)
+    prepared = await _prepare_file(repo_base_path, relative_file_path, rag_processor, llm_type)
+    if isinstance(prepared, list):
+        return prepared
+
+    # --- LLM + Streaming Parse Step ---
+    # Findings are decoded and validated as the response streams in
+    parser = JSONArrayStreamParser()
+    file_results = []
+    async for chunk in astream_completion(llm_type, prepared["user_prompt"], SYSTEM_PROMPT, prepared["semantic_key"]):
+        file_results.extend(_validate_findings(parser.feed(chunk), relative_file_path))
+    llm_response_text = parser.text.strip()
+
+    if not llm_response_text:
+        logger.error("Failed to get LLM response for file: %s", relative_file_path)
+        return [] # Return empty list for this file on failure
+
+    if not parser.complete:
+        if parser.is_array and file_results:
+            # Stream cut short (error or max tokens): keep the findings decoded so far, but do not
+            # cache them, so the file is analyzed in full again next scan
+            logger.warning("Incomplete LLM response for %s. Keeping %s findings decoded before it ended.", relative_file_path, len(file_results))
+            if prepared["truncated"]:
+                for finding in file_results:
+                    finding["truncated"] = True
+            return file_results
+        # Not a clean JSON array (object, truncated stream, ...): parse the full text instead
+        file_results = _parse_findings(llm_response_text, relative_file_path)
+        if file_results is None:
+            return [] # Return empty list if parsing fails
+
+    return _store_findings(prepared, file_results, relative_file_path)
+
+async def analyze_code_file_batch(repo_base_path: str, file_paths: list[str], rag_processor: RAGProcessor, llm_type: str) -> list:
+    """
+    Analyzes several small files with a single LLM request.
+
+    Sharing one request amortizes the system prompt and norms over all files in the batch.
+    Falls back to per-file analysis when the response cannot be attributed to files.
+    """
+    logger.info("Analyzing batch of %s files: %s", len(file_paths), file_paths)
+    files = []
+    contents = await asyncio.gather(*(_read_file(repo_base_path, path) for path in file_paths))
+    for relative_file_path, code_content in zip(file_paths, contents):
+        if not code_content:
+            logger.warning("Skipping empty or unreadable file: %s", relative_file_path)
+            continue
+        files.append((relative_file_path, code_content))
+    if not files:
+        return []
+
+    # --- RAG Step ---
+    file_norms = await asyncio.gather(*(rag_processor.aretrieve_relevant_norms(code_content) for _, code_content in files))
+
+    # --- Findings Cache Step ---
+    batch_results = []
+    uncached_files, uncached_norms, cache_keys = [], [], {}
+    for (relative_file_path, code_content), norms in zip(files, file_norms):
+        cache_key = _findings_cache_key(code_content, norms, llm_type)
+        cached_results = _get_cached_findings(cache_key, relative_file_path)
+        if cached_results is not None:
+            logger.info("Reusing %s cached findings for unchanged file: %s", len(cached_results), relative_file_path)
+            batch_results.extend(cached_results)
+            continue
+        cache_keys[relative_file_path] = cache_key
+        uncached_files.append((relative_file_path, code_content))
+        uncached_norms.append(norms)
+    if not uncached_files:
+        return batch_results
+    files = uncached_files
+    # Union of each file's norms, de-duplicated while keeping retrieval order
+    relevant_norms = list(dict.fromkeys(norm for norms in uncached_norms for norm in norms))
+
+    # --- LLM Step ---
+    user_prompt = create_batch_user_prompt(files, relevant_norms)
+    # No semantic key: a cached response of another batch is keyed by that batch's file paths
+    llm_response_text = await agenerate_completion(llm_type, user_prompt, BATCH_SYSTEM_PROMPT)
+
+    # --- Parsing Step ---
+    parsed_batch = parse_llm_response_to_json(llm_response_text) if llm_response_text else None
+    if not isinstance(parsed_batch, dict):
+        logger.warning("Batch response for %s was missing or not a JSON object keyed by file. Falling back to per-file analysis.", file_paths)
+        per_file = await asyncio.gather(*(analyze_code_file(repo_base_path, path, rag_processor, llm_type) for path, _ in files))
+        return batch_results + [finding for file_findings in per_file for finding in file_findings]
+
+    for relative_file_path, _ in files:
+        parsed_findings = parsed_batch.get(relative_file_path)
+        if parsed_findings is None:
+            logger.warning("Batch response did not include file %s. Treating as no findings.", relative_file_path)
+            continue
+        if isinstance(parsed_findings, dict):
+            parsed_findings = [parsed_findings]
+        elif not isinstance(parsed_findings, list):
+            logger.error("Batch findings for %s are not a list. Type: %s.", relative_file_path, type(parsed_findings))
+            continue
+        file_results = _validate_findings(parsed_findings, relative_file_path)
+        _findings_cache.set(cache_keys[relative_file_path], file_results)
+        logger.info("Found %s potential tech debt items in %s", len(file_results), relative_file_path)
+        batch_results.extend(file_results)
+    return batch_results
+
+def _pack_batches(repo_path: str, code_files: list[str]) -> list[list[str]]:
+    """
+    Greedily packs files into batches of at most LLM_BATCH_SIZE files and LLM_BATCH_TOKEN_BUDGET tokens.
+    Files too large for the budget get a batch of their own.
+    """
+    if config.LLM_BATCH_SIZE <= 1:
+        return [[path] for path in code_files]
+
+    # Cheap size check first: a token is at least one byte, so tokenizing only matters for small files
+    small_files = []
+    for file_rel_path in code_files:
+        try:
+            if os.path.getsize(os.path.join(repo_path, file_rel_path)) <= config.LLM_BATCH_TOKEN_BUDGET * 8:
+                small_files.append(file_rel_path)
+        except OSError:
+            pass
+    # Concurrent reads; they also warm the read cache for the analysis step
+    contents = utils.read_files_bulk(repo_path, small_files)
+
+    batches = []
+    current, current_tokens = [], 0
+    for file_rel_path in code_files:
+        too_large = file_rel_path not in contents
+        tokens = None
+        if not too_large:
+            tokens = utils.estimate_tokens(contents[file_rel_path] or "")
+            too_large = tokens > config.LLM_BATCH_TOKEN_BUDGET
+        if too_large:
+            batches.append([file_rel_path])
+            continue
+        if len(current) >= config.LLM_BATCH_SIZE or current_tokens + tokens > config.LLM_BATCH_TOKEN_BUDGET:
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(file_rel_path)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def _order_for_prefix_cache(batches: list[list[str]]) -> list[list[str]]:
+    """
+    Orders requests so those sharing a prompt prefix are dispatched back-to-back, within the provider's
+    prefix-cache window: single-file requests (SYSTEM_PROMPT) before batched ones (BATCH_SYSTEM_PROMPT),
+    each sorted by path so files of one directory, which tend to retrieve the same norms, are adjacent.
+    """
+    return sorted(batches, key=lambda batch: (len(batch) > 1, batch[0]))
+
+async def _analyze_with_sem(sem: asyncio.Semaphore, job_id: str, repo_path: str, batch: list[str], rag_processor: RAGProcessor, llm_type: str, results: dict) -> list:
+    """Analyzes one batch of files while holding a slot of the LLM concurrency semaphore."""
+    async with sem:
+        if utils.SHUTDOWN.is_set():
+            raise RuntimeError("Service is shutting down.") # Queued requests are dropped; in-flight ones finish
+        if len(batch) == 1:
+            file_findings = await analyze_code_file(repo_path, batch[0], rag_processor, llm_type)
+        else:
+            file_findings = await analyze_code_file_batch(repo_path, batch, rag_processor, llm_type)
+    # Safe without a lock: tasks share one event loop and there is no await between read and write
+    results["files_scanned"] += len(batch)
+    logger.info("[%s] Finished %s/%s files: %s", job_id, results['files_scanned'], results['total_files'], batch)
+    return file_findings
+
+async def _analyze_with_batch_api(job_id: str, repo_path: str, code_files: list[str], rag_processor: RAGProcessor, results: dict) -> list:
+    """
+    Analyzes files through the OpenAI Batch API (one request per file) for large OpenAI scans.
+    Files whose batch request failed are retried with regular requests.
+    """
+    sem = asyncio.Semaphore(config.MAX_LLM_CONCURRENCY)
+
+    async def prepare(relative_file_path):
+        async with sem:
+            return await _prepare_file(repo_path, relative_file_path, rag_processor, 'openai')
+
+    prepared_files = await asyncio.gather(*(prepare(f) for f in code_files))
+    all_findings = []
+    pending = []
+    for relative_file_path, prepared in zip(code_files, prepared_files):
+        if isinstance(prepared, list):
+            all_findings.extend(prepared)
+        else:
+            pending.append((relative_file_path, prepared))
+
+    logger.info("[%s] Submitting %s files to the OpenAI Batch API (%s cached or skipped).", job_id, len(pending), len(code_files) - len(pending))
+    responses = await asyncio.to_thread(batch_generate_completions, [prepared["user_prompt"] for _, prepared in pending], SYSTEM_PROMPT)
+
+    retry_files = []
+    for (relative_file_path, prepared), llm_response_text in zip(pending, responses):
+        file_results = _parse_findings(llm_response_text, relative_file_path) if llm_response_text else None
+        if file_results is None:
+            retry_files.append(relative_file_path)
+            continue
+        all_findings.extend(_store_findings(prepared, file_results, relative_file_path))
+    results["files_scanned"] = len(code_files) - len(retry_files)
+
+    if retry_files:
+        logger.warning("[%s] %s files failed in the OpenAI batch. Retrying them with regular requests.", job_id, len(retry_files))
+        retry_outcomes = await asyncio.gather(
+            *(_analyze_with_sem(sem, job_id, repo_path, [f], rag_processor, 'openai', results) for f in retry_files),
+            return_exceptions=True,
+        )
+        for relative_file_path, outcome in zip(retry_files, retry_outcomes):
+            if isinstance(outcome, BaseException):
+                logger.error("[%s] Error analyzing file %s: %s", job_id, relative_file_path, outcome)
+            else:
+                all_findings.extend(outcome)
+    return all_findings
+
+def _within_scan_size_limit(repo_path: str, relative_file_path: str) -> bool:
+    """True if the file exists and is at most MAX_SCAN_FILE_BYTES."""
+    try:
+        return os.path.getsize(os.path.join(repo_path, relative_file_path)) <= config.MAX_SCAN_FILE_BYTES
+    except OSError:
+        return False # E.g. a broken symlink
+
+async def run_scan(job_id: str, repo_url: str, llm_type: str, rag: RAGProcessor | None = None) -> dict:
     """The main agentic workflow: clone, setup RAG, scan files, aggregate results"""
-    start_time = time.time()
+    start_time = time.monotonic() # Monotonic: durations must not jump with wall-clock adjustments
     # Initialize results structure clearly 
     results = { "job_id": job_id, "repo_url": repo_url, "llm_type": llm_type, "status": "INITIALIZING", "findings": [], "error": None, "files_scanned": 0, "total_files": 0, "duration_seconds": 0.0 }
     repo_path = None
+    rag_processor = None
 
     try:
         results["status"] = "CLONING"
-        logging.info(f"[{job_id}] Starting scan for repo: {repo_url}")
+        logger.info("[%s] Starting scan for repo: %s", job_id, repo_url)
         # 1. Clone Repo
         repo_path = utils.clone_repo(repo_url, job_id)
         if not repo_path:
             raise ValueError(f"Failed to clone repository: {repo_url}")
-        logging.info(f"[{job_id}] Repository cloned to: {repo_path}")
+        logger.info("[%s] Repository cloned to: %s", job_id, repo_path)
 
         results["status"] = "INITIALIZING_RAG"
         # 2. Initialize RAG
-        # Ensure index is up-to-date if norms change frequently, otherwise loading is fine
-        rag_processor = RAGProcessor()
+        # Shared across scans: the embedding model and index are only loaded once per process
+        rag_processor = rag or await asyncio.to_thread(get_rag_processor)
         if rag_processor.vector_store is None:
             # Log clearly but proceed without RAG context if store failed to load/build
-            logging.warning(f"[{job_id}] RAG processor initialized without a valid vector store. Norm retrieval will be skipped.")
+            logger.warning("[%s] RAG processor initialized without a valid vector store. Norm retrieval will be skipped.", job_id)
             # Decide if this should be a fatal error:
             # raise ValueError("Failed to initialize RAG vector store. Cannot proceed.")
 
         results["status"] = "FINDING_FILES"
         # 3. Find Code Files
         code_files = utils.find_code_files(repo_path)
+        # Oversized files (generated code, bundles, data) would cost embeddings and LLM calls for little value
+        scannable_files = [f for f in code_files if _within_scan_size_limit(repo_path, f)]
+        if len(scannable_files) < len(code_files):
+            logger.info("[%s] Skipping %s files larger than %s bytes.", job_id, len(code_files) - len(scannable_files), config.MAX_SCAN_FILE_BYTES)
+        code_files = scannable_files
         results["total_files"] = len(code_files)
         if not code_files:
             results["status"] = "COMPLETED"
             results["message"] = "No code files found matching allowed extensions."
-            logging.info(f"[{job_id}] No matching code files found.")
+            logger.info("[%s] No matching code files found.", job_id)
             # No 'return' here, proceed to cleanup
 
         else:
             results["status"] = "ANALYZING"
-            logging.info(f"[{job_id}] Found {len(code_files)} files to analyze.")
-            # 4. Analyze Files (Iterative Step)
-            all_findings = []
-            for i, file_rel_path in enumerate(code_files):
-                # Update status for progress tracking (optional)
-                # results["status"] = f"ANALYZING ({i+1}/{results['total_files']})"
-                logging.info(f"[{job_id}] Processing file {i+1}/{results['total_files']}: {file_rel_path}")
-                try:
-                    file_findings = analyze_code_file(repo_path, file_rel_path, rag_processor, llm_type)
-                    if file_findings: # Only add if findings exist
-                        all_findings.extend(file_findings)
-                    results["files_scanned"] += 1
-                except Exception as file_error:
-                    # Log error for specific file but continue scan
-                    logging.error(f"[{job_id}] Error analyzing file {file_rel_path}: {file_error}")
-                    # Optionally add file-specific errors to results
-                    # results.setdefault("file_errors", []).append({"file": file_rel_path, "error": str(file_error)})
-
+            logger.info("[%s] Found %s files to analyze.", job_id, len(code_files))
+            # 4. Analyze Files (Concurrent Step)
+            if llm_type == 'openai' and 0 < config.OPENAI_BATCH_THRESHOLD < len(code_files):
+                # Large offline sweep: half-price Batch API, no per-minute rate limits
+                all_findings = await _analyze_with_batch_api(job_id, repo_path, code_files, rag_processor, results)
+            else:
+                # Submit every file first, then collect: awaiting inside the submission loop would serialize the LLM calls
+                # Tasks take semaphore slots in creation order, so the prefix-cache ordering is the dispatch order
+                batches = _order_for_prefix_cache(_pack_batches(repo_path, code_files))
+                logger.info("[%s] Packed %s files into %s LLM requests.", job_id, len(code_files), len(batches))
+                sem = asyncio.Semaphore(config.MAX_LLM_CONCURRENCY)
+                tasks = [
+                    asyncio.create_task(_analyze_with_sem(sem, job_id, repo_path, batch, rag_processor, llm_type, results))
+                    for batch in batches
+                ]
+                batch_outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+                if utils.SHUTDOWN.is_set():
+                    raise RuntimeError("Scan interrupted: the service is shutting down.")
+
+                all_findings = []
+                for batch, outcome in zip(batches, batch_outcomes):
+                    if isinstance(outcome, BaseException):
+                        # Log error for specific batch but continue scan
+                        logger.error("[%s] Error analyzing files %s: %s", job_id, batch, outcome)
+                        # Optionally add file-specific errors to results
+                        # results.setdefault("file_errors", []).append({"files": batch, "error": str(outcome)})
+                    elif outcome: # Only add if findings exist
+                        all_findings.extend(outcome)
 
             results["findings"] = all_findings
+            results["rag_cache"] = rag_processor.norms_cache.stats()
             results["status"] = "COMPLETED"
-            logging.info(f"[{job_id}] Scan completed. Found {len(all_findings)} total findings in {results['files_scanned']} files.")
+            logger.info("[%s] Scan completed. Found %s total findings in %s files.", job_id, len(all_findings), results['files_scanned'])
 
     except Exception as e:
-        logging.exception(f"[{job_id}] Critical error during scan: {e}") # Log full traceback
+        logger.exception("[%s] Critical error during scan: %s", job_id, e) # Log full traceback
         results["status"] = "FAILED"
         results["error"] = str(e)
 
     finally:
         # 5. Cleanup
+        # The LLM connection pools and the RAG batcher belong to this scan's event loop
+        await aclose_async_clients()
+        if rag_processor is not None:
+            await rag_processor.aclose_batcher()
         if repo_path:
             utils.cleanup_repo(repo_path)
 
-        end_time = time.time()
+        end_time = time.monotonic()
         results["duration_seconds"] = round(end_time - start_time, 2)
-        logging.info(f"[{job_id}] Job finished. Status: {results['status']}. Duration: {results['duration_seconds']}s")
+        logger.info("[%s] Job finished. Status: %s. Duration: %ss", job_id, results['status'], results['duration_seconds'])
 
     return results
@@ -1,26 +1,47 @@
 
 # Flask application for Tech Debt Analyzer API
 # This application provides endpoints to start scans, check their status, and rebuild the RAG index.
+import logging_config # Configures logging before the other modules log
 import os
+import asyncio
+import atexit
 import logging
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
 import threading
 import time # Needed for sleep if using polling simulation
+from concurrent.futures import ThreadPoolExecutor
 
 import config
 from agent import run_scan
-from rag_processor import RAGProcessor # Import for rebuild endpoint
+from rag_processor import get_rag_processor # Shared instance for scans and rebuilds
 import utils # For job ID generation
+import llm_interface
+from job_store import ShardedJobStore
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
+# --- JSON Serialization ---
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson, which encodes large findings lists far faster than stdlib json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=_ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Send orjson's bytes as-is instead of decoding to str and re-encoding to UTF-8
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=_ORJSON_OPTIONS), mimetype="application/json")
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.secret_key = config.FLASK_SECRET_KEY
 
 # 2. Initialize CORS
@@ -32,60 +53,83 @@ CORS(app, resources={r"/*": {"origins": "http://localhost:3000"}})
 # In-memory storage for job status and results
 # WARNING: This is not persistent and not suitable for production.
 # Use Redis, a database, or a proper task queue (Celery) for production.
-jobs = {} # Dictionary to store job_id -> job_data
+# Sharded so that updates and polls for different jobs do not block each other;
+# the least recently used jobs are evicted beyond MAX_STORED_JOBS
+job_store = ShardedJobStore(max_jobs=config.MAX_STORED_JOBS)
+
+# Bounded pool of scan workers, so bursts of /scan requests queue up instead of spawning a thread each
+SCAN_EXECUTOR = ThreadPoolExecutor(max_workers=config.MAX_CONCURRENT_SCANS, thread_name_prefix="scan")
 
-# Lock for thread-safe access to the 'jobs' dictionary
-jobs_lock = threading.Lock()
+# Admission gate for running + queued scans; when exhausted /scan answers 503 (back-pressure)
+scan_slots = threading.BoundedSemaphore(config.MAX_PENDING_SCANS)
+
+# At most one RAG rebuild is queued or running; further /rag/rebuild requests get its job_id
+# instead of tying up another scan worker waiting on the rebuild lock
+active_rebuild_job_id = None
+active_rebuild_lock = threading.Lock()
 
 # --- Helper Function for Background Task ---
 def run_scan_background(job_id, repo_url, llm_type):
     """Target function for the background thread."""
-    global jobs
-    logger.info(f"Starting background scan for job_id: {job_id}")
+    logger.info("Starting background scan for job_id: %s", job_id)
     scan_results = {}
     try:
         # Update status to RUNNING immediately after thread starts
-        with jobs_lock:
-            if job_id in jobs:
-                jobs[job_id]["status"] = "RUNNING"
-                jobs[job_id]["start_time"] = time.time() # Record start time
-            else:
-                 logger.error(f"Job {job_id} not found in jobs dict at start of background task.")
-                 return # Should not happen if called correctly
+        if not job_store.update(job_id, {"status": "RUNNING", "start_time": time.time()}): # Record start time
+            logger.error("Job %s not found in job store at start of background task.", job_id)
+            return # Should not happen if called correctly
 
         # Execute the main scan logic
-        scan_results = run_scan(job_id, repo_url, llm_type)
-
-        # Update the jobs dictionary with the final results
-        with jobs_lock:
-            if job_id in jobs:
-                # Merge results, preserving initial info if needed
-                jobs[job_id].update(scan_results)
-                jobs[job_id]["end_time"] = time.time() # Record end time
-            else:
-                # This case might occur if the job was somehow removed
-                logger.warning(f"Job {job_id} finished but was not found in jobs dict. Storing results anyway.")
-                jobs[job_id] = scan_results # Store fresh results
+        scan_results = asyncio.run(run_scan(job_id, repo_url, llm_type, rag=get_rag_processor()))
 
-        logger.info(f"Background scan finished for job_id: {job_id}. Final Status: {scan_results.get('status')}")
+        # Update the job store with the final results
+        # Merge results, preserving initial info if needed
+        if not job_store.update(job_id, {**scan_results, "end_time": time.time()}): # Record end time
+            # This case might occur if the job was somehow removed (e.g. evicted)
+            logger.warning("Job %s finished but was not found in job store. Storing results anyway.", job_id)
+            job_store.put(job_id, scan_results) # Store fresh results
+
+        logger.info("Background scan finished for job_id: %s. Final Status: %s", job_id, scan_results.get('status'))
 
     except Exception as e:
-        logger.exception(f"Critical error in background thread for job {job_id}: {e}")
+        logger.exception("Critical error in background thread for job %s: %s", job_id, e)
         # Update job status to FAILED on unexpected thread error
-        with jobs_lock:
-            if job_id in jobs:
-                jobs[job_id]["status"] = "FAILED"
-                jobs[job_id]["error"] = f"Background task failed unexpectedly: {str(e)}"
-                jobs[job_id]["end_time"] = time.time()
-            else:
-                 # Store error info even if job entry was lost
-                 jobs[job_id] = {
-                     "job_id": job_id,
-                     "status": "FAILED",
-                     "error": f"Background task failed unexpectedly after job entry lost: {str(e)}",
-                     "findings": [],
-                     "end_time": time.time()
-                 }
+        failure = {
+            "status": "FAILED",
+            "error": f"Background task failed unexpectedly: {str(e)}",
+            "end_time": time.time()
+        }
+        if not job_store.update(job_id, failure):
+            # Store error info even if job entry was lost
+            job_store.put(job_id, {
+                "job_id": job_id,
+                "status": "FAILED",
+                "error": f"Background task failed unexpectedly after job entry lost: {str(e)}",
+                "findings": [],
+                "end_time": time.time()
+            })
+
+def rebuild_rag_background(job_id):
+    """Target function for a background RAG index rebuild."""
+    job_store.update(job_id, {"status": "RUNNING", "start_time": time.time()})
+    try:
+        # Rebuild the shared processor's index so running and future scans see the new norms
+        # (rebuild_index serializes concurrent rebuilds)
+        get_rag_processor().rebuild_index()
+        logger.info("RAG index rebuild completed successfully for job_id: %s", job_id)
+        job_store.update(job_id, {"status": "COMPLETED", "message": "RAG index rebuild successful.", "end_time": time.time()})
+    except Exception as e:
+        logger.exception("Error during RAG index rebuild for job %s:", job_id)
+        job_store.update(job_id, {
+            "status": "FAILED",
+            "error": f"Failed to rebuild RAG index: {str(e)}",
+            "end_time": time.time()
+        })
+    finally:
+        global active_rebuild_job_id
+        with active_rebuild_lock:
+            if active_rebuild_job_id == job_id:
+                active_rebuild_job_id = None
 
 # --- API Endpoints ---
 
@@ -95,7 +139,6 @@ def start_scan_endpoint():
     Starts a new tech debt scan.
     Requires JSON body: {"repo_url": "...", "llm_type": "openai|ollama"}
     """
-    global jobs
     data = request.get_json()
 
     if not data:
@@ -126,9 +169,14 @@ def start_scan_endpoint():
         # Add check for Ollama model availability if desired (requires ollama client here)
 
     if errors:
-        logger.warning(f"Scan request validation failed: {errors}")
+        logger.warning("Scan request validation failed: %s", errors)
         return jsonify({"error": "Invalid request parameters", "details": errors}), 400
 
+    # --- Back-pressure ---
+    if not scan_slots.acquire(blocking=False):
+        logger.warning("Rejecting scan request: scan queue is full.")
+        return jsonify({"error": "Too many scans in progress. Please retry later."}), 503, {"Retry-After": "30"}
+
     # --- Job Creation ---
     job_id = utils.generate_job_id()
     job_data = {
@@ -141,63 +189,72 @@ def start_scan_endpoint():
         "error": None
     }
 
-    with jobs_lock:
-        jobs[job_id] = job_data
+    job_store.put(job_id, job_data)
 
     # --- Start Background Task ---
     try:
-        thread = threading.Thread(target=run_scan_background, args=(job_id, repo_url, llm_type), daemon=True)
-        # daemon=True allows the main Flask app to exit even if scan threads are running.
-        # Set to False if you need scans to complete before the app can shut down gracefully.
-        thread.start()
-        logger.info(f"Scan initiated for {repo_url} using {llm_type}. Job ID: {job_id}")
+        future = SCAN_EXECUTOR.submit(run_scan_background, job_id, repo_url, llm_type)
+        # Free the admission slot once the scan has finished (successfully or not)
+        future.add_done_callback(lambda _: scan_slots.release())
+        logger.info("Scan initiated for %s using %s. Job ID: %s", repo_url, llm_type, job_id)
         # Return the initial job data with the PENDING status
         return jsonify(job_data), 202 # HTTP 202 Accepted: Request accepted, processing started
 
     except Exception as e:
-         logger.exception(f"Failed to start background thread for job {job_id}: {e}")
+         logger.exception("Failed to start background thread for job %s: %s", job_id, e)
+         scan_slots.release()
          # Clean up job entry if thread failed to start
-         with jobs_lock:
-             if job_id in jobs:
-                 del jobs[job_id]
+         job_store.delete(job_id)
          return jsonify({"error": "Failed to initiate scan process."}), 500
 
 
 @app.route('/status/<job_id>', methods=['GET'])
 def get_status_endpoint(job_id):
     """Checks the status and results of a scan job."""
-    global jobs
-
-    with jobs_lock:
-        job_info = jobs.get(job_id) # Get a copy or access safely
+    job_info = job_store.get(job_id) # Snapshot taken under the job's shard lock
 
     if not job_info:
-        logger.warning(f"Status request for unknown job_id: {job_id}")
+        logger.warning("Status request for unknown job_id: %s", job_id)
         return jsonify({"error": "Job ID not found"}), 404
 
-    # Return the current state of the job (make a copy to avoid race conditions if needed)
-    # Since we're using a lock, accessing job_info directly after retrieval is safe here.
+    # Return the current state of the job; job_info is a copy, so later updates cannot race with serialization
     return jsonify(job_info)
 
 @app.route('/rag/rebuild', methods=['POST'])
 def rebuild_rag_index_endpoint():
     """
     Triggers a rebuild of the RAG vector store index.
-    NOTE: This runs synchronously and might block the server for a while.
-    Consider making this asynchronous for production.
+    The rebuild runs on the scan worker pool; poll /status/<job_id> for completion.
+    While a rebuild is queued or running, its job is returned instead of starting another.
     """
+    global active_rebuild_job_id
     logger.info("Received request to rebuild RAG index.")
     # Potentially add authentication/authorization here
-    try:
-        # Initialize the processor which handles loading/creating the store
-        rag_processor = RAGProcessor()
-        # Call the explicit rebuild method
-        rag_processor.rebuild_index()
-        logger.info("RAG index rebuild completed successfully.")
-        return jsonify({"message": "RAG index rebuild successful."}), 200
-    except Exception as e:
-        logger.exception("Error during RAG index rebuild:")
-        return jsonify({"error": f"Failed to rebuild RAG index: {str(e)}"}), 500
+    with active_rebuild_lock:
+        if active_rebuild_job_id is not None:
+            active_job = job_store.get(active_rebuild_job_id)
+            if active_job:
+                logger.info("RAG index rebuild already in progress: %s", active_rebuild_job_id)
+                return jsonify({**active_job, "message": "RAG index rebuild already in progress."}), 202
+
+        job_id = utils.generate_job_id()
+        job_data = {
+            "job_id": job_id,
+            "type": "rag_rebuild",
+            "status": "PENDING",
+            "submitted_at": time.time(),
+            "error": None
+        }
+        job_store.put(job_id, job_data)
+
+        try:
+            SCAN_EXECUTOR.submit(rebuild_rag_background, job_id)
+            active_rebuild_job_id = job_id
+            return jsonify({**job_data, "message": "RAG index rebuild started."}), 202
+        except Exception as e:
+            logger.exception("Failed to start RAG index rebuild for job %s: %s", job_id, e)
+            job_store.delete(job_id)
+            return jsonify({"error": f"Failed to initiate RAG index rebuild: {str(e)}"}), 500
 
 @app.route('/', methods=['GET'])
 def index():
@@ -220,28 +277,27 @@ def ensure_initial_setup():
     norms_exist = os.path.exists(config.NORMS_DIR) and os.listdir(config.NORMS_DIR)
 
     if not norms_exist:
-        logger.warning(f"Norms directory '{config.NORMS_DIR}' is empty or does not exist.")
+        logger.warning("Norms directory '%s' is empty or does not exist.", config.NORMS_DIR)
         try:
             os.makedirs(config.NORMS_DIR, exist_ok=True)
             dummy_norm_path = os.path.join(config.NORMS_DIR, "placeholder_norm.txt")
             if not os.path.exists(dummy_norm_path):
                  with open(dummy_norm_path, "w") as f:
                     f.write("This is a placeholder norm file. Replace with your actual organizational norms.\n")
-                 logger.info(f"Created placeholder norm file: {dummy_norm_path}")
+                 logger.info("Created placeholder norm file: %s", dummy_norm_path)
             else:
                  logger.info("Placeholder norm file already exists.")
             # Attempt to build index even with placeholder
             logger.info("Attempting to build initial RAG index with placeholder norm...")
-            rag_proc = RAGProcessor()
-            rag_proc.rebuild_index() # This will create an index based on the placeholder
+            get_rag_processor().rebuild_index() # This will create an index based on the placeholder
         except Exception as e:
-            logger.error(f"Failed during initial setup (creating norms/building index): {e}")
+            logger.error("Failed during initial setup (creating norms/building index): %s", e)
     else:
-        logger.info(f"Norms directory '{config.NORMS_DIR}' found. Assuming RAG index exists or will be loaded/created by RAGProcessor on demand.")
+        logger.info("Norms directory '%s' found. Assuming RAG index exists or will be loaded/created by RAGProcessor on demand.", config.NORMS_DIR)
         # Optionally trigger a check/build here too if you want to ensure it's always fresh on startup
         # try:
         #     logger.info("Verifying/Loading RAG index on startup...")
-        #     RAGProcessor() # Instantiating it triggers load/create
+        #     get_rag_processor() # First access triggers load/create
         # except Exception as e:
         #     logger.error(f"Failed to load/create RAG index on startup: {e}")
 
@@ -249,8 +305,18 @@ def ensure_initial_setup():
 # --- Main Execution ---
 if __name__ == '__main__':
     ensure_initial_setup()
+    # Connect the shared LLM clients once, instead of probing on every request
+    llm_interface.warmup()
+    atexit.register(llm_interface.close)
     # Run Flask app
     # Use host='0.0.0.0' to make it accessible on the network
     # Use debug=False for production/stable runs
     logger.info("Starting Flask application server...")
-    app.run(host='0.0.0.0', port=5001, debug=False)
+    try:
+        app.run(host='0.0.0.0', port=5001, debug=False)
+    finally:
+        # Scan workers are not daemon threads and are joined at exit: drop queued scans and
+        # signal running ones to stop at their next request instead of running to completion
+        logger.info("Shutting down: stopping running scans.")
+        utils.SHUTDOWN.set()
+        SCAN_EXECUTOR.shutdown(wait=False, cancel_futures=True)
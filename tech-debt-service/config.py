@@ -6,24 +6,59 @@ load_dotenv()
 # --- General ---
 FLASK_SECRET_KEY = os.getenv('FLASK_SECRET_KEY', 'default-secret-key')
 REPO_CLONE_DIR = os.getenv('REPO_CLONE_DIR', './cloned_repos')
+CLONE_SPARSE_PATHS = [p.strip() for p in os.getenv('CLONE_SPARSE_PATHS', '').split(',') if p.strip()] # Directories to check out (empty = whole repo)
 NORMS_DIR = os.getenv('NORMS_DIR', './norms')
 ALLOWED_EXTENSIONS = os.getenv('ALLOWED_EXTENSIONS', '.py').split(',')
+MAX_FILE_BYTES = int(os.getenv('MAX_FILE_BYTES', 100_000)) # Larger files are truncated before analysis
+MAX_SCAN_FILE_BYTES = int(os.getenv('MAX_SCAN_FILE_BYTES', 200_000)) # Larger files are skipped entirely
+# Directories never scanned (.git is always excluded)
+EXCLUDED_DIRS = {d.strip() for d in os.getenv('EXCLUDED_DIRS', '.git,node_modules,dist,build,__pycache__,.venv,vendor').split(',') if d.strip()} | {'.git'}
 
 # --- RAG ---
 EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'all-MiniLM-L6-v2')
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch').lower() # 'torch' or 'onnx'
+EMBEDDING_ONNX_FILE = os.getenv('EMBEDDING_ONNX_FILE', 'onnx/model_qint8_avx512_vnni.onnx') # Used with the 'onnx' backend
+EMBEDDING_DEVICE = os.getenv('EMBEDDING_DEVICE', 'auto').lower() # 'auto', 'cpu', 'cuda', 'mps', ...
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 64)) # Texts per encode batch
 VECTOR_STORE_PATH = os.getenv('VECTOR_STORE_PATH', './vector_store_faiss')
 CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 1000))
 CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', 100))
 RAG_TOP_K = int(os.getenv('RAG_TOP_K', 3))
+FAISS_INDEX_TYPE = os.getenv('FAISS_INDEX_TYPE', 'flat').lower() # 'flat' (exact), 'ivfpq' (compressed) or 'hnsw' (graph)
+FAISS_NPROBE = int(os.getenv('FAISS_NPROBE', 8)) # IVF lists searched per query (ivfpq only)
+RAG_CACHE_SIMILARITY = float(os.getenv('RAG_CACHE_SIMILARITY', 0.95)) # Cosine similarity for reusing cached norms (>1 disables)
+RAG_CACHE_DIR = os.getenv('RAG_CACHE_DIR', './rag_cache') # Persistent exact-match cache of retrieved norms
+RAG_BATCH_WINDOW_MS = int(os.getenv('RAG_BATCH_WINDOW_MS', 10)) # How long to gather concurrent retrievals into one batch
+RAG_BATCH_MAX_SIZE = int(os.getenv('RAG_BATCH_MAX_SIZE', 32)) # Max retrievals embedded per batch
 
 # --- LLM ---
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_MODEL_NAME = os.getenv('OPENAI_MODEL_NAME', 'gpt-4o-mini')
 OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
 OLLAMA_MODEL_NAME = os.getenv('OLLAMA_MODEL_NAME', 'llama3') # Ensure this model is pulled in Ollama
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', 120)) # Seconds before an LLM request is abandoned (and retried)
+LLM_MAX_TOKENS = int(os.getenv('LLM_MAX_TOKENS', 2048)) # Cap on generated tokens per response
+LLM_TEMPERATURE = float(os.getenv('LLM_TEMPERATURE', 0.0)) # 0 = deterministic JSON output
+MAX_LLM_CONCURRENCY = int(os.getenv('MAX_LLM_CONCURRENCY', 8)) # Max in-flight LLM requests per scan
+LLM_BATCH_SIZE = int(os.getenv('LLM_BATCH_SIZE', 4)) # Max small files per LLM request (1 disables batching)
+LLM_BATCH_TOKEN_BUDGET = int(os.getenv('LLM_BATCH_TOKEN_BUDGET', 4000)) # Max code tokens per batched request
+OPENAI_BATCH_THRESHOLD = int(os.getenv('OPENAI_BATCH_THRESHOLD', 0)) # Use the OpenAI Batch API above this many files (0 disables)
+OPENAI_BATCH_POLL_SECONDS = int(os.getenv('OPENAI_BATCH_POLL_SECONDS', 30)) # Interval between Batch API status checks
+LLM_SEMANTIC_CACHE_ENABLED = os.getenv('LLM_SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true' # Reuse responses to near-identical prompts
+LLM_SEMANTIC_CACHE_THRESHOLD = float(os.getenv('LLM_SEMANTIC_CACHE_THRESHOLD', 0.92)) # Cosine similarity of prompt embeddings
+LLM_SEMANTIC_CACHE_DIR = os.getenv('LLM_SEMANTIC_CACHE_DIR', './llm_semantic_cache')
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'false').lower() == 'true' # Reuse responses to identical prompts (only at temperature 0)
+LLM_CACHE_DIR = os.getenv('LLM_CACHE_DIR', './llm_response_cache')
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', 7 * 24 * 3600)) # Seconds a cached response is kept, exact and semantic caches (0 = forever)
 
 # --- Agent ---
 TECH_DEBT_CATEGORIES = os.getenv('TECH_DEBT_CATEGORIES', 'Unknown')
+FINDINGS_CACHE_DIR = os.getenv('FINDINGS_CACHE_DIR', './findings_cache') # Findings of unchanged files, reused across scans
+
+# --- Service ---
+MAX_CONCURRENT_SCANS = int(os.getenv('MAX_CONCURRENT_SCANS', 2)) # Scans running at the same time
+MAX_PENDING_SCANS = int(os.getenv('MAX_PENDING_SCANS', 10)) # Running + queued scans before /scan returns 503
+MAX_STORED_JOBS = int(os.getenv('MAX_STORED_JOBS', 200)) # Jobs kept in memory (least recently used are evicted)
 
 # --- Derived ---
 os.makedirs(REPO_CLONE_DIR, exist_ok=True)
@@ -0,0 +1,57 @@
+import math
+import threading
+from collections import OrderedDict
+
+class ShardedJobStore:
+    """
+    In-memory job store split into independently locked shards.
+
+    Requests for different jobs rarely contend for the same lock, so status polling does not
+    serialize behind background updates. Each shard keeps its jobs in LRU order and evicts the
+    least recently used ones beyond its share of `max_jobs`.
+    """
+
+    def __init__(self, shards: int = 16, max_jobs: int = 200):
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._max_per_shard = max(1, math.ceil(max_jobs / shards))
+
+    def _shard(self, job_id: str) -> int:
+        return hash(job_id) % len(self._shards)
+
+    def get(self, job_id: str) -> dict | None:
+        """Returns a snapshot of the job, or None if it is unknown."""
+        s = self._shard(job_id)
+        with self._locks[s]:
+            job = self._shards[s].get(job_id)
+            if job is None:
+                return None
+            self._shards[s].move_to_end(job_id) # Mark as recently used
+            return dict(job)
+
+    def put(self, job_id: str, job_data: dict):
+        """Stores (or replaces) a job. A copy is stored, so the caller's dict stays a stable snapshot."""
+        job_data = dict(job_data)
+        s = self._shard(job_id)
+        with self._locks[s]:
+            shard = self._shards[s]
+            shard[job_id] = job_data
+            shard.move_to_end(job_id)
+            while len(shard) > self._max_per_shard:
+                shard.popitem(last=False)
+
+    def update(self, job_id: str, patch: dict) -> bool:
+        """Merges `patch` into an existing job. Returns False if the job is unknown."""
+        s = self._shard(job_id)
+        with self._locks[s]:
+            job = self._shards[s].get(job_id)
+            if job is None:
+                return False
+            job.update(patch)
+            return True
+
+    def delete(self, job_id: str):
+        """Removes a job if present."""
+        s = self._shard(job_id)
+        with self._locks[s]:
+            self._shards[s].pop(job_id, None)
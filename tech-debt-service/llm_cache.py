@@ -0,0 +1,116 @@
+import logging
+import os
+import threading
+import time
+import faiss
+import numpy as np
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Candidates checked per lookup; near neighbours from other namespaces (models, system prompts, norms) are skipped
+_SEARCH_K = 8
+
+class SemanticResponseCache:
+    """
+    Persistent cache of LLM responses keyed by the embedding of the analyzed code.
+
+    A lookup returns the response for the most similar earlier code in the same namespace
+    (LLM type, model, system prompt and norms) whose cosine similarity is at least `threshold`.
+    Entries are appended to a JSONL file under `path` and re-indexed on start-up. Entries older than
+    `ttl` seconds (0 = never) are not returned and are dropped from the file on the next start-up.
+    """
+
+    def __init__(self, embedder, dim: int, path: str, threshold: float = 0.92, chunk_chars: int = 1000, ttl: int = 0):
+        self.embedder = embedder
+        self.threshold = threshold
+        # Code files are often longer than the embedding model's input window, so they are embedded in chunks
+        self.chunk_chars = chunk_chars
+        self._index = faiss.IndexFlatIP(dim) # Inner product of L2-normalized vectors = cosine similarity
+        self.ttl = ttl
+        self._entries = [] # (namespace, response, created) per index row
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self._log_path = os.path.join(path, "responses.jsonl")
+        self._load()
+
+    def _expired(self, created: float) -> bool:
+        return bool(self.ttl) and created < time.time() - self.ttl
+
+    def _load(self):
+        if not os.path.exists(self._log_path):
+            return
+        vectors = []
+        kept_lines = []
+        dropped = 0
+        with open(self._log_path, "rb") as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    logger.warning("Skipping corrupt line in LLM response cache.")
+                    dropped += 1
+                    continue
+                created = record.get("created", 0.0) # Written by versions without expiry
+                if self._expired(created):
+                    dropped += 1
+                    continue
+                vectors.append(record["vector"])
+                self._entries.append((record["namespace"], record["response"], created))
+                kept_lines.append(line)
+        if dropped:
+            # Compact the file so it does not grow without bound across restarts
+            tmp_path = self._log_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.writelines(kept_lines)
+            os.replace(tmp_path, self._log_path)
+        if vectors:
+            self._index.add(np.asarray(vectors, dtype=np.float32))
+        logger.info("Loaded %s cached LLM responses from %s (%s expired or corrupt dropped)", len(self._entries), self._log_path, dropped)
+
+    def embed(self, text: str) -> np.ndarray:
+        """Embeds the text as the normalized mean of its chunk embeddings."""
+        chunks = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)] or [""]
+        vectors = np.asarray(self.embedder.embed_documents(chunks), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        vec = vectors.mean(axis=0)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def lookup(self, vec: np.ndarray, namespace: str) -> str | None:
+        """Returns the cached response for the most similar code in `namespace`, or None."""
+        with self._lock:
+            if self._index.ntotal:
+                scores, ids = self._index.search(vec.reshape(1, -1), min(_SEARCH_K, self._index.ntotal))
+                for score, idx in zip(scores[0], ids[0]):
+                    if idx < 0 or score < self.threshold:
+                        break # Results are sorted by similarity
+                    entry_namespace, response, created = self._entries[idx]
+                    if entry_namespace == namespace and not self._expired(created):
+                        self.hits += 1
+                        return response
+            self.misses += 1
+            return None
+
+    def add(self, vec: np.ndarray, namespace: str, response: str):
+        """Stores a response under the code embedding and appends it to the cache file."""
+        created = time.time()
+        record = orjson.dumps({"namespace": namespace, "vector": vec, "response": response, "created": created}, option=orjson.OPT_SERIALIZE_NUMPY)
+        with self._lock:
+            self._index.add(vec.reshape(1, -1).astype(np.float32))
+            self._entries.append((namespace, response, created))
+            with open(self._log_path, "ab") as f:
+                f.write(record + b"\n")
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters for monitoring."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
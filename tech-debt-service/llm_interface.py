@@ -1,48 +1,76 @@
+import asyncio
+import diskcache
+import functools
+import hashlib
+import httpx
 import logging
+import random
 import re
 import time
+import weakref
 import config
 import json
+import orjson
+import utils
+from llm_cache import SemanticResponseCache
 
 # LLM Clients
-from openai import OpenAI, RateLimitError, APIError, OpenAIError
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIError, OpenAIError
 import ollama # Official Ollama client
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # --- Constants ---
 MAX_RETRIES = 3
-RETRY_DELAY = 5 # seconds
+RETRY_BASE_DELAY = 1 # seconds; doubled on every attempt
+MAX_RETRY_DELAY = 60 # seconds
 
 # --- LLM Client Initialization ---
 
+# Shared by every client: keep-alive connections avoid a TCP+TLS handshake per LLM call
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0)
+_HTTP_TIMEOUT = httpx.Timeout(config.LLM_REQUEST_TIMEOUT, connect=10.0) # Bounds a hung request
+
+# Sent with every OpenAI completion: a capped output bounds cost and latency, temperature 0 keeps the JSON deterministic
+_OPENAI_GENERATION_PARAMS = {"max_tokens": config.LLM_MAX_TOKENS, "temperature": config.LLM_TEMPERATURE}
+# Ollama equivalent. Requests sharing a system prompt reuse its KV cache prefix without further options.
+_OLLAMA_OPTIONS = {"num_predict": config.LLM_MAX_TOKENS, "temperature": config.LLM_TEMPERATURE}
+
+@functools.lru_cache(maxsize=1)
 def get_openai_client():
-    """Initializes and returns the OpenAI client."""
+    """Returns the process-wide OpenAI client, created on first use."""
     if not config.OPENAI_API_KEY:
-        logging.error("OpenAI API Key not found in configuration.")
+        logger.error("OpenAI API Key not found in configuration.")
         return None
+    return OpenAI(api_key=config.OPENAI_API_KEY, http_client=httpx.Client(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT))
+
+@functools.lru_cache(maxsize=1)
+def get_ollama_client():
+    """Returns the process-wide Ollama client, created on first use."""
+    return ollama.Client(host=config.OLLAMA_BASE_URL, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+
+def _check_openai():
+    """Verifies the OpenAI key and connectivity with one models.list() call."""
+    client = get_openai_client()
+    if not client:
+        return
     try:
-        client = OpenAI(api_key=config.OPENAI_API_KEY)
-        # Test connection (optional, but good practice)
         client.models.list()
-        logging.info("OpenAI client initialized successfully.")
-        return client
+        logger.info("OpenAI client initialized successfully.")
     except APIError as e:
-        logging.error(f"OpenAI API Error during initialization: {e}")
-        return None
+        logger.error("OpenAI API Error during initialization: %s", e)
     except OpenAIError as e:
-        logging.error(f"OpenAI general error during initialization: {e}")
-        return None
+        logger.error("OpenAI general error during initialization: %s", e)
 
-def get_ollama_client():
-    """Initializes and returns the Ollama client."""
+def _check_ollama():
+    """Verifies the Ollama host is reachable and the configured model has been pulled."""
     # Use configured base URL consistently
     ollama_host = config.OLLAMA_BASE_URL
     try:
-        client = ollama.Client(host=ollama_host)
+        client = get_ollama_client()
         # Test connection and get model list ONCE
         model_list_response = client.list()
-        logging.info(f"Ollama client initialized successfully for host {ollama_host}.")
+        logger.info("Ollama client initialized successfully for host %s.", ollama_host)
 
         # --- Robustly extract model names (Updated Check) ---
         available_models = []
@@ -54,9 +82,9 @@ def get_ollama_client():
                     available_models.append(m.model) # <<< FIX: Access the 'model' attribute >>>
                 else:
                     # Log the entry if it doesn't have the expected structure
-                    logging.warning(f"Skipping entry without 'model' attribute in Ollama list response: {m}")
+                    logger.warning("Skipping entry without 'model' attribute in Ollama list response: %s", m)
         else:
-             logging.warning(f"Ollama list response did not contain a valid 'models' list: {model_list_response}")
+             logger.warning("Ollama list response did not contain a valid 'models' list: %s", model_list_response)
         # --- End of robust extraction ---
 
         # Check if the desired model exists locally
@@ -72,26 +100,298 @@ def get_ollama_client():
         # If the desired name didn't include a tag, check if a ':latest' version exists
         elif ':' not in desired_model_name and f"{desired_model_name}:latest" in available_models:
              found = True
-             logging.info(f"Found '{desired_model_name}:latest' for configured model '{desired_model_name}'.")
-             # Optional: Update model_name used later if needed, but usually Ollama handles 'model' vs 'model:latest'
-             # config.OLLAMA_MODEL_NAME = f"{desired_model_name}:latest"
+             logger.info("Found '%s:latest' for configured model '%s'.", desired_model_name, desired_model_name)
 
         if not found:
-             logging.warning(f"Ollama model '{desired_model_name}' not found locally. Available models: {available_models}. Make sure it's pulled (`ollama pull {desired_model_name}`).")
-             # Depending on policy, you might want to raise an error here or proceed cautiously.
-             # return None # Or raise an error if model must exist
-
-        return client
+             logger.warning("Ollama model '%s' not found locally. Available models: %s. Make sure it's pulled (`ollama pull %s`).", desired_model_name, available_models, desired_model_name)
     except Exception as e:
-        # Log the specific host URL attempted
-        logging.error(f"Failed to initialize Ollama client or connect to {ollama_host}: {e}")
-        # Log the full exception traceback for better debugging
-        logging.exception("Full exception details during Ollama client initialization:")
+        # OLLAMA_BASE_URL has a default, so OpenAI-only deployments get here on every start: no traceback
+        logger.warning("Could not connect to Ollama at %s: %s", ollama_host, e)
+
+def warmup():
+    """
+    Creates the configured LLM clients and checks connectivity once at service start,
+    instead of probing on every completion request.
+    """
+    if config.OPENAI_API_KEY:
+        _check_openai()
+    if config.OLLAMA_BASE_URL:
+        _check_ollama()
+
+def close():
+    """Closes the process-wide clients and their connection pools; call on shutdown."""
+    if get_openai_client.cache_info().currsize:
+        client = get_openai_client()
+        if client:
+            client.close()
+        get_openai_client.cache_clear()
+    if get_ollama_client.cache_info().currsize:
+        get_ollama_client().close()
+        get_ollama_client.cache_clear()
+
+# Async clients are bound to the event loop that first uses their connection pool, and every scan
+# runs its own loop (asyncio.run), so they are cached per loop and closed by aclose_async_clients.
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+
+def _loop_clients() -> dict:
+    loop = asyncio.get_running_loop()
+    clients = _ASYNC_CLIENTS.get(loop)
+    if clients is None:
+        clients = _ASYNC_CLIENTS[loop] = {}
+    return clients
+
+def get_async_openai_client():
+    """Returns the async OpenAI client of the running event loop, creating it on first use."""
+    if not config.OPENAI_API_KEY:
+        logger.error("OpenAI API Key not found in configuration.")
         return None
+    clients = _loop_clients()
+    # No models.list() probe here: the async client is used on the hot path of a scan.
+    if 'openai' not in clients:
+        clients['openai'] = AsyncOpenAI(api_key=config.OPENAI_API_KEY, http_client=httpx.AsyncClient(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT))
+    return clients['openai']
+
+def get_async_ollama_client():
+    """Returns the async Ollama client of the running event loop, creating it on first use."""
+    clients = _loop_clients()
+    if 'ollama' not in clients:
+        clients['ollama'] = ollama.AsyncClient(host=config.OLLAMA_BASE_URL, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+    return clients['ollama']
+
+async def aclose_async_clients():
+    """Closes the async clients of the running event loop; call before the loop ends."""
+    clients = _ASYNC_CLIENTS.pop(asyncio.get_running_loop(), {})
+    for llm_type, client in clients.items():
+        try:
+            await client.close() # Release the underlying httpx connection pool
+        except Exception as e:
+            logger.warning("Failed to close async %s client: %s", llm_type, e)
+
+_CLIENTS = {'openai': get_openai_client, 'ollama': get_ollama_client}
+_ASYNC_CLIENTS_BY_TYPE = {'openai': get_async_openai_client, 'ollama': get_async_ollama_client}
+
+def _model_name(llm_type: str) -> str:
+    return config.OPENAI_MODEL_NAME if llm_type == 'openai' else config.OLLAMA_MODEL_NAME
+
+def _build_messages(prompt: str, system_prompt: str | None) -> list:
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+def _prepare_request(llm_type: str, prompt: str, system_prompt: str | None, client_getters: dict):
+    """
+    Resolves the client, model name and chat messages of a request.
+
+    Returns:
+        (client, model_name, messages); client is None if the LLM type is unsupported or not configured (error logged).
+    """
+    get_client = client_getters.get(llm_type)
+    if get_client is None:
+        logger.error("Unsupported LLM type: %s", llm_type)
+        return None, None, None
+    return get_client(), _model_name(llm_type), _build_messages(prompt, system_prompt)
+
+# --- Prompt Prefix Caching ---
+
+@functools.lru_cache(maxsize=16)
+def _prompt_cache_key(system_prompt: str | None) -> str:
+    """Stable OpenAI prompt_cache_key so requests sharing a system prompt are routed to the same prefix cache."""
+    digest = hashlib.blake2b((system_prompt or "").encode(), digest_size=8).hexdigest()
+    return f"tech-debt-system-{digest}"
+
+# --- Semantic Response Cache ---
+
+@functools.lru_cache(maxsize=1)
+def get_response_cache() -> SemanticResponseCache:
+    """Returns the process-wide semantic response cache, sharing the RAG processor's embedding model."""
+    from rag_processor import get_rag_processor # Deferred: loads the embedding model and index
+    rag_processor = get_rag_processor()
+    return SemanticResponseCache(
+        rag_processor.embeddings,
+        rag_processor.norms_cache.dim,
+        config.LLM_SEMANTIC_CACHE_DIR,
+        threshold=config.LLM_SEMANTIC_CACHE_THRESHOLD,
+        ttl=config.LLM_CACHE_TTL,
+    )
+
+def _cache_namespace(llm_type: str, system_prompt: str | None, context: str) -> str:
+    return f"{llm_type}:{_model_name(llm_type)}:{_prompt_cache_key(system_prompt)}:{context}"
+
+def _semantic_lookup(llm_type: str, system_prompt: str | None, semantic_key: tuple[str, str] | None):
+    """
+    Looks up a response for similar code with the same context (norms) and system prompt.
+
+    Returns:
+        (cached response or None, (embedding, namespace) for _semantic_store); the second item is
+        None when the cache is disabled or the request has no semantic key.
+    """
+    if not config.LLM_SEMANTIC_CACHE_ENABLED or semantic_key is None:
+        return None, None
+    code, context = semantic_key
+    cache = get_response_cache()
+    # Only the code is embedded: the rest of the prompt (instructions, norms) is shared by unrelated files
+    # and would dominate the similarity. Everything else must match exactly, through the namespace.
+    code_vec = cache.embed(code)
+    namespace = _cache_namespace(llm_type, system_prompt, context)
+    cached = cache.lookup(code_vec, namespace)
+    if cached is not None:
+        logger.debug("Semantic cache hit for %s prompt.", llm_type)
+    return cached, (code_vec, namespace)
+
+def _semantic_store(semantic_entry, response: str) -> str:
+    """Caches the response when the cache is enabled and returns it unchanged."""
+    if semantic_entry is not None and response:
+        get_response_cache().add(*semantic_entry, response)
+    return response
+
+# --- Exact Response Cache ---
+# Only deterministic (temperature 0) responses are cached, so a hit is what the API would have returned
+_exact_cache = diskcache.Cache(config.LLM_CACHE_DIR) if config.LLM_CACHE_ENABLED and config.LLM_TEMPERATURE == 0 else None
+
+def _exact_key(llm_type: str, prompt: str, system_prompt: str | None) -> str:
+    return hashlib.blake2b(f"{llm_type}:{_model_name(llm_type)}\x00{system_prompt or ''}\x00{prompt}".encode()).hexdigest()
+
+def _cache_lookup(llm_type: str, prompt: str, system_prompt: str | None, semantic_key: tuple[str, str] | None = None):
+    """
+    Checks the exact cache, then the semantic cache (only for requests with a semantic key).
+
+    Returns:
+        (cached response or None, entry to pass to _cache_store once a response arrives).
+    """
+    key = None
+    if _exact_cache is not None:
+        key = _exact_key(llm_type, prompt, system_prompt)
+        cached = _exact_cache.get(key)
+        if cached is not None:
+            logger.debug("Exact cache hit for %s prompt.", llm_type)
+            return cached, None
+    cached, semantic_entry = _semantic_lookup(llm_type, system_prompt, semantic_key)
+    return cached, (key, semantic_entry)
+
+def _cache_store(llm_type: str, system_prompt: str | None, entry, response: str) -> str:
+    """Stores the response in the enabled caches and returns it unchanged."""
+    key, semantic_entry = entry
+    if key is not None and response:
+        _exact_cache.set(key, response, expire=config.LLM_CACHE_TTL or None)
+    return _semantic_store(semantic_entry, response)
+
+# --- Retry Backoff ---
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    """
+    Seconds to wait before the next attempt: the server's Retry-After when it sends one,
+    otherwise exponential backoff with jitter so concurrent workers do not retry in lockstep.
+    """
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return min(MAX_RETRY_DELAY, float(retry_after))
+        except ValueError:
+            pass # An HTTP date; fall back to backoff
+    return min(MAX_RETRY_DELAY, RETRY_BASE_DELAY * 2 ** attempt) + random.uniform(0, RETRY_BASE_DELAY)
+
+# --- Provider Calls ---
+# One function per provider and call style, dispatched through dicts so the retry loops do not re-branch on llm_type
+
+def _call_openai(client, model_name: str, messages: list, system_prompt: str | None) -> str:
+    response = client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        extra_body={"prompt_cache_key": _prompt_cache_key(system_prompt)},
+        timeout=config.LLM_REQUEST_TIMEOUT,
+        **_OPENAI_GENERATION_PARAMS,
+        # response_format={ "type": "json_object" } # If you want guaranteed JSON (GPT-4 Turbo+)
+    )
+    content = response.choices[0].message.content
+    logger.debug("OpenAI Response: %.100s...", content)
+    return content
+
+def _call_ollama(client, model_name: str, messages: list, system_prompt: str | None) -> str:
+    # Ollama client uses a slightly different structure
+    ollama_response = client.chat(
+        model=model_name,
+        messages=messages,
+        options=_OLLAMA_OPTIONS,
+        # Ollama supports format='json' for some models
+        # format='json' # Uncomment if your Ollama model supports JSON mode reliably
+    )
+    content = ollama_response['message']['content']
+    logger.debug("Ollama Response: %.100s...", content)
+    return content
+
+async def _acall_openai(client, model_name: str, messages: list, system_prompt: str | None) -> str:
+    response = await client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        extra_body={"prompt_cache_key": _prompt_cache_key(system_prompt)},
+        timeout=config.LLM_REQUEST_TIMEOUT,
+        **_OPENAI_GENERATION_PARAMS,
+    )
+    content = response.choices[0].message.content
+    logger.debug("OpenAI Response: %.100s...", content)
+    return content
+
+async def _acall_ollama(client, model_name: str, messages: list, system_prompt: str | None) -> str:
+    ollama_response = await client.chat(
+        model=model_name,
+        messages=messages,
+        options=_OLLAMA_OPTIONS,
+    )
+    content = ollama_response['message']['content']
+    logger.debug("Ollama Response: %.100s...", content)
+    return content
+
+def _stream_openai(client, model_name: str, messages: list, system_prompt: str | None):
+    stream = client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        extra_body={"prompt_cache_key": _prompt_cache_key(system_prompt)},
+        timeout=config.LLM_REQUEST_TIMEOUT,
+        **_OPENAI_GENERATION_PARAMS,
+        stream=True,
+    )
+    for chunk in stream:
+        content = chunk.choices[0].delta.content if chunk.choices else None
+        if content:
+            yield content
+
+def _stream_ollama(client, model_name: str, messages: list, system_prompt: str | None):
+    for part in client.chat(model=model_name, messages=messages, options=_OLLAMA_OPTIONS, stream=True):
+        content = part['message']['content']
+        if content:
+            yield content
+
+async def _astream_openai(client, model_name: str, messages: list, system_prompt: str | None):
+    stream = await client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        extra_body={"prompt_cache_key": _prompt_cache_key(system_prompt)},
+        timeout=config.LLM_REQUEST_TIMEOUT,
+        **_OPENAI_GENERATION_PARAMS,
+        stream=True,
+    )
+    async for chunk in stream:
+        content = chunk.choices[0].delta.content if chunk.choices else None
+        if content:
+            yield content
+
+async def _astream_ollama(client, model_name: str, messages: list, system_prompt: str | None):
+    async for part in await client.chat(model=model_name, messages=messages, options=_OLLAMA_OPTIONS, stream=True):
+        content = part['message']['content']
+        if content:
+            yield content
+
+_CALLS = {'openai': _call_openai, 'ollama': _call_ollama}
+_ACALLS = {'openai': _acall_openai, 'ollama': _acall_ollama}
+_STREAMS = {'openai': _stream_openai, 'ollama': _stream_ollama}
+_ASTREAMS = {'openai': _astream_openai, 'ollama': _astream_ollama}
 
 # --- Unified LLM Interaction ---
 
-def generate_completion(llm_type: str, prompt: str, system_prompt: str = None) -> str | None:
+def generate_completion(llm_type: str, prompt: str, system_prompt: str = None, semantic_key: tuple[str, str] | None = None) -> str | None:
     """
     Generates a completion using the specified LLM type.
 
@@ -99,72 +399,338 @@ def generate_completion(llm_type: str, prompt: str, system_prompt: str = None) -
         llm_type: 'openai' or 'ollama'.
         prompt: The main user prompt/query.
         system_prompt: An optional system message for context/instructions.
+        semantic_key: Optional (code, context) pair that enables the semantic cache: a response for similar
+            code with the same context (e.g. a hash of the norms in the prompt) is reused. Skipped if None.
 
     Returns:
         The LLM's response content as a string, or None if an error occurs.
     """
-    logging.debug(f"Generating completion using {llm_type}")
-    client = None
-    model_name = ""
-
-    if llm_type == 'openai':
-        client = get_openai_client()
-        model_name = config.OPENAI_MODEL_NAME
-        if not client: return None # Error logged in get_openai_client
-    elif llm_type == 'ollama':
-        client = get_ollama_client()
-        model_name = config.OLLAMA_MODEL_NAME
-        if not client: return None # Error logged in get_ollama_client
-    else:
-        logging.error(f"Unsupported LLM type: {llm_type}")
+    logger.debug("Generating completion using %s", llm_type)
+    client, model_name, messages = _prepare_request(llm_type, prompt, system_prompt, _CLIENTS)
+    if client is None:
         return None
 
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.append({"role": "user", "content": prompt})
+    # Repeated and near-duplicate prompts (boilerplate files) reuse an earlier response
+    cached, cache_entry = _cache_lookup(llm_type, prompt, system_prompt, semantic_key)
+    if cached is not None:
+        return cached
 
+    call = _CALLS[llm_type]
     for attempt in range(MAX_RETRIES):
         try:
-            if llm_type == 'openai':
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=messages,
-                    # Consider adding temperature, max_tokens etc. if needed
-                    # response_format={ "type": "json_object" } # If you want guaranteed JSON (GPT-4 Turbo+)
-                )
-                content = response.choices[0].message.content
-                logging.debug(f"OpenAI Response: {content[:100]}...")
-                return content.strip()
-
-            elif llm_type == 'ollama':
-                # Ollama client uses a slightly different structure
-                ollama_response = client.chat(
-                    model=model_name,
-                    messages=messages,
-                    # Ollama supports format='json' for some models
-                    # format='json' # Uncomment if your Ollama model supports JSON mode reliably
-                )
-                content = ollama_response['message']['content']
-                logging.debug(f"Ollama Response: {content[:100]}...")
-                return content.strip()
+            content = call(client, model_name, messages, system_prompt)
+            return _cache_store(llm_type, system_prompt, cache_entry, content.strip())
 
         except RateLimitError as e:
-            logging.warning(f"Rate limit exceeded (Attempt {attempt + 1}/{MAX_RETRIES}). Retrying in {RETRY_DELAY}s... Error: {e}")
-            time.sleep(RETRY_DELAY)
+            if attempt == MAX_RETRIES - 1:
+                logger.warning("Rate limit exceeded (Attempt %s/%s). Giving up. Error: %s", attempt + 1, MAX_RETRIES, e)
+                break # No point waiting up to MAX_RETRY_DELAY before giving up
+            delay = _retry_delay(attempt, e)
+            logger.warning("Rate limit exceeded (Attempt %s/%s). Retrying in %.1fs... Error: %s", attempt + 1, MAX_RETRIES, delay, e)
+            time.sleep(delay)
         except APIError as e:
-            logging.error(f"API Error from {llm_type} (Attempt {attempt + 1}/{MAX_RETRIES}): {e}")
+            logger.error("API Error from %s (Attempt %s/%s): %s", llm_type, attempt + 1, MAX_RETRIES, e)
             # Decide if retryable based on status code if needed
             if attempt == MAX_RETRIES - 1: return None
-            time.sleep(RETRY_DELAY)
+            time.sleep(_retry_delay(attempt, e))
         except (OpenAIError, ollama.ResponseError, Exception) as e: # Catch Ollama specific errors and general exceptions
-            logging.error(f"Error during {llm_type} completion (Attempt {attempt + 1}/{MAX_RETRIES}): {e}")
+            logger.error("Error during %s completion (Attempt %s/%s): %s", llm_type, attempt + 1, MAX_RETRIES, e)
             if attempt == MAX_RETRIES - 1: return None # Failed after retries
-            time.sleep(RETRY_DELAY) # Wait before retrying other errors
+            time.sleep(_retry_delay(attempt, e)) # Wait before retrying other errors
 
-    logging.error(f"Failed to get completion from {llm_type} after {MAX_RETRIES} retries.")
+    logger.error("Failed to get completion from %s after %s retries.", llm_type, MAX_RETRIES)
     return None
 
+async def agenerate_completion(llm_type: str, prompt: str, system_prompt: str = None, semantic_key: tuple[str, str] | None = None) -> str | None:
+    """
+    Async counterpart of generate_completion, so many files can be analyzed concurrently.
+
+    Args:
+        llm_type: 'openai' or 'ollama'.
+        prompt: The main user prompt/query.
+        system_prompt: An optional system message for context/instructions.
+        semantic_key: Optional (code, context) pair that enables the semantic cache: a response for similar
+            code with the same context (e.g. a hash of the norms in the prompt) is reused. Skipped if None.
+
+    Returns:
+        The LLM's response content as a string, or None if an error occurs.
+    """
+    logger.debug("Generating async completion using %s", llm_type)
+    client, model_name, messages = _prepare_request(llm_type, prompt, system_prompt, _ASYNC_CLIENTS_BY_TYPE)
+    if client is None:
+        return None
+
+    # Repeated and near-duplicate prompts (boilerplate files) reuse an earlier response
+    cached, cache_entry = await asyncio.to_thread(_cache_lookup, llm_type, prompt, system_prompt, semantic_key)
+    if cached is not None:
+        return cached
+
+    call = _ACALLS[llm_type]
+    for attempt in range(MAX_RETRIES):
+        try:
+            content = await call(client, model_name, messages, system_prompt)
+            return await asyncio.to_thread(_cache_store, llm_type, system_prompt, cache_entry, content.strip())
+
+        except RateLimitError as e:
+            if attempt == MAX_RETRIES - 1:
+                logger.warning("Rate limit exceeded (Attempt %s/%s). Giving up. Error: %s", attempt + 1, MAX_RETRIES, e)
+                break # No point waiting up to MAX_RETRY_DELAY before giving up
+            delay = _retry_delay(attempt, e)
+            logger.warning("Rate limit exceeded (Attempt %s/%s). Retrying in %.1fs... Error: %s", attempt + 1, MAX_RETRIES, delay, e)
+            await asyncio.sleep(delay)
+        except APIError as e:
+            logger.error("API Error from %s (Attempt %s/%s): %s", llm_type, attempt + 1, MAX_RETRIES, e)
+            if attempt == MAX_RETRIES - 1: return None
+            await asyncio.sleep(_retry_delay(attempt, e))
+        except (OpenAIError, ollama.ResponseError, Exception) as e:
+            logger.error("Error during %s completion (Attempt %s/%s): %s", llm_type, attempt + 1, MAX_RETRIES, e)
+            if attempt == MAX_RETRIES - 1: return None
+            await asyncio.sleep(_retry_delay(attempt, e))
+
+    logger.error("Failed to get completion from %s after %s retries.", llm_type, MAX_RETRIES)
+    return None
+
+async def generate_many(llm_type: str, prompts: list[str], system_prompt: str = None, max_concurrency: int = config.MAX_LLM_CONCURRENCY) -> list[str | None]:
+    """
+    Generates completions for many prompts concurrently, at most max_concurrency in flight.
+
+    Sync callers can use asyncio.run(generate_many(...)).
+
+    Returns:
+        One response (or None on error) per prompt, in prompt order.
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def one(prompt):
+        async with sem:
+            return await agenerate_completion(llm_type, prompt, system_prompt)
+
+    return await asyncio.gather(*(one(prompt) for prompt in prompts))
+
+def generate_completion_stream(llm_type: str, prompt: str, system_prompt: str = None, semantic_key: tuple[str, str] | None = None):
+    """
+    Sync counterpart of astream_completion: yields text chunks of the response as they arrive.
+
+    Retries only happen before the first chunk arrives; an error mid-stream ends the stream early.
+    Pair with parse_llm_response_to_json_stream to act on findings before the response completes.
+    semantic_key is as in generate_completion.
+    """
+    logger.debug("Streaming completion using %s", llm_type)
+    client, model_name, messages = _prepare_request(llm_type, prompt, system_prompt, _CLIENTS)
+    if client is None:
+        return
+
+    # Repeated and near-duplicate prompts (boilerplate files) replay an earlier response as a single chunk
+    cached, cache_entry = _cache_lookup(llm_type, prompt, system_prompt, semantic_key)
+    if cached is not None:
+        yield cached
+        return
+
+    stream = _STREAMS[llm_type]
+    for attempt in range(MAX_RETRIES):
+        received = False
+        parts = []
+        try:
+            for content in stream(client, model_name, messages, system_prompt):
+                received = True
+                parts.append(content)
+                yield content
+            # Only complete streams are cached
+            _cache_store(llm_type, system_prompt, cache_entry, "".join(parts).strip())
+            return
+
+        except (RateLimitError, APIError, OpenAIError, ollama.ResponseError, Exception) as e:
+            if received:
+                logger.error("%s stream interrupted after partial output: %s", llm_type, e)
+                return
+            logger.error("Error starting %s stream (Attempt %s/%s): %s", llm_type, attempt + 1, MAX_RETRIES, e)
+            if attempt == MAX_RETRIES - 1: break
+            time.sleep(_retry_delay(attempt, e))
+
+    logger.error("Failed to stream completion from %s after %s retries.", llm_type, MAX_RETRIES)
+
+async def astream_completion(llm_type: str, prompt: str, system_prompt: str = None, semantic_key: tuple[str, str] | None = None):
+    """
+    Streams a completion as text chunks, so callers can parse the output while it is generated.
+
+    Retries only happen before the first chunk arrives; an error mid-stream ends the stream early
+    and leaves it to the caller to handle the partial text. semantic_key is as in generate_completion.
+
+    Yields:
+        Text chunks of the LLM's response content.
+    """
+    logger.debug("Streaming completion using %s", llm_type)
+    client, model_name, messages = _prepare_request(llm_type, prompt, system_prompt, _ASYNC_CLIENTS_BY_TYPE)
+    if client is None:
+        return
+
+    # Repeated and near-duplicate prompts (boilerplate files) replay an earlier response as a single chunk
+    cached, cache_entry = await asyncio.to_thread(_cache_lookup, llm_type, prompt, system_prompt, semantic_key)
+    if cached is not None:
+        yield cached
+        return
+
+    stream = _ASTREAMS[llm_type]
+    for attempt in range(MAX_RETRIES):
+        received = False
+        parts = []
+        try:
+            async for content in stream(client, model_name, messages, system_prompt):
+                received = True
+                parts.append(content)
+                yield content
+            # Only complete streams are cached
+            await asyncio.to_thread(_cache_store, llm_type, system_prompt, cache_entry, "".join(parts).strip())
+            return
+
+        except (RateLimitError, APIError, OpenAIError, ollama.ResponseError, Exception) as e:
+            if received:
+                logger.error("%s stream interrupted after partial output: %s", llm_type, e)
+                return
+            logger.error("Error starting %s stream (Attempt %s/%s): %s", llm_type, attempt + 1, MAX_RETRIES, e)
+            if attempt == MAX_RETRIES - 1: break
+            await asyncio.sleep(_retry_delay(attempt, e))
+
+    logger.error("Failed to stream completion from %s after %s retries.", llm_type, MAX_RETRIES)
+
+
+# --- OpenAI Batch API ---
+_BATCH_TERMINAL_STATUSES = frozenset(("completed", "failed", "expired", "cancelled"))
+
+def batch_generate_completions(prompts: list[str], system_prompt: str = None) -> list[str | None]:
+    """
+    Generates OpenAI completions for many prompts through the Batch API.
+
+    Batch requests cost half as much and do not count against the per-minute rate limits,
+    but complete asynchronously (within 24h), so this blocks while polling the batch.
+    The batch is cancelled (and RuntimeError raised) if the service shuts down meanwhile.
+
+    Returns:
+        One response (or None if that request failed) per prompt, in prompt order.
+    """
+    results = [None] * len(prompts)
+    client = get_openai_client()
+    if not client or not prompts:
+        return results # Error logged in get_openai_client
+
+    lines = []
+    for i, prompt in enumerate(prompts):
+        lines.append(orjson.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": config.OPENAI_MODEL_NAME,
+                "messages": _build_messages(prompt, system_prompt),
+                "prompt_cache_key": _prompt_cache_key(system_prompt),
+                **_OPENAI_GENERATION_PARAMS,
+            },
+        }))
+
+    try:
+        batch_file = client.files.create(file=("requests.jsonl", b"\n".join(lines)), purpose="batch")
+        batch = client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        logger.info("Submitted OpenAI batch %s with %s requests.", batch.id, len(prompts))
+        while batch.status not in _BATCH_TERMINAL_STATUSES:
+            if utils.SHUTDOWN.wait(config.OPENAI_BATCH_POLL_SECONDS):
+                # A batch can take up to 24h; do not hold up the service's exit for it
+                client.batches.cancel(batch.id)
+                raise RuntimeError(f"Service is shutting down. Cancelled OpenAI batch {batch.id}.")
+            batch = client.batches.retrieve(batch.id)
+            logger.debug("OpenAI batch %s status: %s (%s)", batch.id, batch.status, batch.request_counts)
+        if batch.status != "completed":
+            logger.error("OpenAI batch %s ended with status '%s'. Keeping any partial results.", batch.id, batch.status)
+
+        # Expired or cancelled batches can still have an output file for the requests that finished
+        if batch.output_file_id:
+            output = client.files.content(batch.output_file_id).content
+            for line in output.splitlines():
+                # One bad record must not discard the whole batch; its slot stays None and is retried
+                try:
+                    record = orjson.loads(line)
+                    response = record.get("response") or {}
+                    if response.get("status_code") != 200:
+                        logger.error("OpenAI batch request %s failed: %s", record.get('custom_id'), record.get('error') or response.get('body'))
+                        continue
+                    content = response["body"]["choices"][0]["message"]["content"]
+                    results[int(record["custom_id"])] = content.strip() if content else None
+                except (orjson.JSONDecodeError, AttributeError, KeyError, IndexError, TypeError, ValueError) as e:
+                    logger.error("Skipping malformed OpenAI batch output record: %s (%.200s)", e, line)
+    except OpenAIError as e:
+        logger.error("OpenAI Batch API error: %s", e)
+
+    return results
+
+
+_JSON_DECODER = json.JSONDecoder()
+_ITEM_SEPARATORS = " \t\r\n,"
+
+class JSONArrayStreamParser:
+    """
+    Incrementally decodes the items of a top-level JSON array from streamed LLM text.
+
+    Text before the opening '[' (e.g. a ```json fence) and after the closing ']' is ignored.
+    `complete` becomes True once the closing bracket is seen; if it is still False when the
+    stream ends, callers should fall back to parse_llm_response_to_json on `text`.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = None # Index just past the last decoded item; None until '[' is found
+        self.is_array = None
+        self.complete = False
+
+    @property
+    def text(self) -> str:
+        return self._buffer
+
+    def feed(self, chunk: str) -> list:
+        """Appends a chunk and returns the array items completed by it."""
+        self._buffer += chunk
+        if self.complete or self.is_array is False:
+            return []
+        if self._pos is None:
+            start_brace = self._buffer.find('{')
+            start_bracket = self._buffer.find('[')
+            if start_bracket == -1:
+                if start_brace != -1:
+                    self.is_array = False # A JSON object; leave it to the full-text parser
+                return []
+            if start_brace != -1 and start_brace < start_bracket:
+                self.is_array = False
+                return []
+            self.is_array = True
+            self._pos = start_bracket + 1
+        elif '}' not in chunk and ']' not in chunk:
+            return [] # Nothing can have completed without a closing character
+        return self._drain()
+
+    def _drain(self) -> list:
+        items = []
+        buffer = self._buffer
+        while True:
+            pos = self._pos
+            while pos < len(buffer) and buffer[pos] in _ITEM_SEPARATORS:
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                self.complete = True
+                self._pos = pos + 1
+                break
+            try:
+                # raw_decode reports where the item ended, so trailing text is never an error
+                item, end = _JSON_DECODER.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break # Item not fully received yet
+            if end >= len(buffer) and not isinstance(item, (dict, list)):
+                break # A scalar at the end of the buffer may still be growing
+            items.append(item)
+            self._pos = end
+        return items
+
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*([\s\S]*?)\s*```", re.IGNORECASE)
 
 def parse_llm_response_to_json(response_text: str) -> list | dict | None:
     """
@@ -175,44 +741,60 @@ def parse_llm_response_to_json(response_text: str) -> list | dict | None:
     if not response_text:
         return None
 
-    # Try finding JSON within markdown code blocks
-    match = re.search(r"```(json)?\s*([\s\S]*?)\s*```", response_text, re.IGNORECASE)
+    # Try finding JSON within markdown code blocks; models emitting raw JSON skip the regex entirely
+    match = _FENCE_RE.search(response_text) if '```' in response_text else None
     if match:
-        json_str = match.group(2).strip()
+        json_str = match.group(1).strip()
     else:
         # Assume the whole response might be JSON, or JSON might start somewhere
-        # Find the first '{' or '[' to potentially trim leading text
-        start_brace = response_text.find('{')
-        start_bracket = response_text.find('[')
-
-        if start_brace == -1 and start_bracket == -1:
-             logging.warning("Could not find JSON start characters '{' or '[' in LLM response.")
+        # Trim leading text up to the first '{' or '['; trailing text is handled by the decoder below
+        start = min((i for i in (response_text.find('{'), response_text.find('[')) if i >= 0), default=-1)
+        if start == -1:
+             logger.warning("Could not find JSON start characters '{' or '[' in LLM response.")
              return None # No JSON structure found
-
-        if start_brace != -1 and (start_bracket == -1 or start_brace < start_bracket):
-            json_str = response_text[start_brace:]
-        elif start_bracket != -1:
-             json_str = response_text[start_bracket:]
-        else: # Should not happen based on above logic, but for safety
-             json_str = response_text
-
-        # Attempt to find the matching closing brace/bracket (simple heuristic)
-        # This is NOT a robust JSON parser, but helps trim trailing text.
-        # A more robust approach would use a JSON parsing library that can handle partial data or errors.
-        # For simplicity, we'll just try parsing directly.
+        json_str = response_text[start:]
 
     try:
         # Ensure json_str is not empty after potential trimming
         if not json_str:
-            logging.warning("Extracted JSON string is empty.")
+            logger.warning("Extracted JSON string is empty.")
             return None
-        parsed_json = json.loads(json_str)
+        # orjson decodes str directly; encoding to bytes first would only add a copy
+        parsed_json = orjson.loads(json_str)
+        return parsed_json
+    except orjson.JSONDecodeError:
+        pass # Often prose after the JSON; retried below
+    try:
+        # raw_decode stops at the end of the first JSON value, so trailing text is ignored
+        parsed_json, _ = _JSON_DECODER.raw_decode(json_str)
+        logger.debug("Decoded JSON after ignoring trailing text in LLM response.")
         return parsed_json
     except json.JSONDecodeError as e:
-        logging.error(f"Failed to decode JSON from LLM response: {e}")
-        logging.debug(f"Problematic JSON string (approx): {json_str[:500]}...") # Log part of the string
+        logger.error("Failed to decode JSON from LLM response: %s", e)
+        logger.debug("Problematic JSON string (approx): %.500s...", json_str) # Log part of the string
         return None
     except Exception as e:
-        logging.error(f"An unexpected error occurred during JSON parsing: {e}")
+        logger.error("An unexpected error occurred during JSON parsing: %s", e)
         return None
 
+def parse_llm_response_to_json_stream(chunks):
+    """
+    Yields the items of a JSON array response as soon as each one is complete.
+
+    If the streamed text turns out not to be a clean JSON array (an object, a truncated stream, ...),
+    the full text is parsed with parse_llm_response_to_json at the end and the items not yet yielded
+    (or the single object) are yielded then.
+    """
+    parser = JSONArrayStreamParser()
+    yielded = 0
+    for chunk in chunks:
+        for item in parser.feed(chunk):
+            yielded += 1
+            yield item
+    if parser.complete:
+        return
+    parsed = parse_llm_response_to_json(parser.text)
+    if isinstance(parsed, list):
+        yield from parsed[yielded:]
+    elif parsed is not None and not yielded:
+        yield parsed
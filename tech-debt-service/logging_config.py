@@ -0,0 +1,7 @@
+import logging
+
+# Configured once for the whole service; modules log through logging.getLogger(__name__)
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
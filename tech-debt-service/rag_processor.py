@@ -1,31 +1,239 @@
 import os
+import asyncio
+import hashlib
 import logging
+import math
+import multiprocessing
+import threading
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import diskcache
+import faiss
+import numpy as np
+import orjson
 import config
+import utils
+from semantic_cache import SemanticCache
 
 # Langchain components for RAG
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings # If using OpenAI embeddings
 from langchain_community.embeddings import HuggingFaceEmbeddings # For Sentence Transformers
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import DirectoryLoader, TextLoader, UnstructuredMarkdownLoader
+from langchain_community.document_loaders import TextLoader, UnstructuredMarkdownLoader
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class BatchEmbedder:
+    """
+    Coalesces concurrent norm retrievals issued on one event loop into batched calls.
+
+    Requests arriving within `window_ms` of each other (up to `max_batch`) are embedded with a
+    single encode call and searched together, which costs far less per item than one-by-one.
+    """
+
+    def __init__(self, retrieve_batch, window_ms: int = 10, max_batch: int = 32):
+        self._retrieve_batch = retrieve_batch
+        self._window = window_ms / 1000
+        self._max_batch = max_batch
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def aclose(self):
+        """Stops the batching task; must be awaited on the loop the batcher was created on."""
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def retrieve(self, query_text: str, k: int) -> list[str]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query_text, k, future))
+        return await future
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._window
+            while len(batch) < self._max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            by_k = {}
+            for query_text, k, future in batch:
+                by_k.setdefault(k, []).append((query_text, future))
+            for k, requests in by_k.items():
+                try:
+                    # Embedding is CPU-bound; keep it off the event loop
+                    results = await asyncio.to_thread(self._retrieve_batch, [q for q, _ in requests], k)
+                except Exception as e:
+                    for _, future in requests:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, future), norms in zip(requests, results):
+                    if not future.done():
+                        future.set_result(norms)
+
+# Loader per norm file extension; UnstructuredMarkdownLoader requires the 'unstructured' library
+_NORM_LOADERS = {
+    ".txt": TextLoader,
+    ".md": UnstructuredMarkdownLoader,
+}
+_PARALLEL_LOAD_MIN_FILES = 8
+
+def _load_one(path: str) -> list:
+    """Loads one norm file; module-level so it can run in a worker process. Errors are logged and skipped."""
+    try:
+        return _NORM_LOADERS[Path(path).suffix](path).load()
+    except Exception as e:
+        logger.error("Error loading norm file %s: %s", path, e)
+        return []
+
+def _embedding_device() -> str:
+    """Returns EMBEDDING_DEVICE, resolving 'auto' to CUDA, then Apple MPS, then CPU."""
+    if config.EMBEDDING_DEVICE != 'auto':
+        return config.EMBEDDING_DEVICE
+    try:
+        import torch # Installed with sentence-transformers
+    except ImportError:
+        return 'cpu'
+    if torch.cuda.is_available():
+        return 'cuda'
+    if torch.backends.mps.is_available():
+        return 'mps'
+    return 'cpu'
+
+def _build_ann_index(flat_index):
+    """
+    Rebuilds a flat index as FAISS_INDEX_TYPE ('ivfpq' or 'hnsw') from its stored vectors.
+    Returns the flat index unchanged for 'flat' or when there are too few vectors to train IVF-PQ.
+    """
+    index_type = config.FAISS_INDEX_TYPE
+    if index_type == 'flat':
+        return flat_index
+    d, n = flat_index.d, flat_index.ntotal
+    vectors = flat_index.reconstruct_n(0, n)
+    # L2 metric throughout: LangChain's FAISS wrapper scores results as Euclidean distances
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(d, 32)
+    elif index_type == 'ivfpq':
+        nlist = max(32, int(math.sqrt(n)))
+        # Each of the 8-bit PQ codebooks needs at least 256 training vectors, and IVF one per list
+        if n < max(256, nlist) or d % 8:
+            logger.info("Keeping a flat index: %s vectors of dim %s are not enough to train IVF-PQ.", n, d)
+            return flat_index
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, nlist, 8, 8)
+        index.train(vectors)
+        index.nprobe = min(nlist, config.FAISS_NPROBE)
+    else:
+        logger.warning("Unknown FAISS_INDEX_TYPE '%s'. Keeping a flat index.", index_type)
+        return flat_index
+    index.add(vectors)
+    logger.info("Built %s FAISS index over %s vectors.", index_type, n)
+    return index
+
+# Vector store layout: the raw FAISS index plus one JSON line per chunk (no pickle)
+_INDEX_FILE = "index.faiss"
+_DOCS_FILE = "docs.jsonl"
+
+def _save_vector_store(db, path: str):
+    """Writes the index and its documents (in index order); temp files plus rename keep readers consistent."""
+    os.makedirs(path, exist_ok=True)
+    index_path = os.path.join(path, _INDEX_FILE)
+    docs_path = os.path.join(path, _DOCS_FILE)
+    faiss.write_index(db.index, index_path + ".tmp")
+    with open(docs_path + ".tmp", "wb") as f:
+        for _, doc_id in sorted(db.index_to_docstore_id.items()):
+            doc = db.docstore.search(doc_id)
+            f.write(orjson.dumps({"id": doc_id, "page_content": doc.page_content, "metadata": doc.metadata}, default=str) + b"\n")
+    os.replace(index_path + ".tmp", index_path)
+    os.replace(docs_path + ".tmp", docs_path)
+
+def _load_vector_store(path: str, embeddings):
+    """Loads a store written by _save_vector_store; the index is memory-mapped where FAISS supports it."""
+    index_path = os.path.join(path, _INDEX_FILE)
+    try:
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP)
+    except RuntimeError:
+        index = faiss.read_index(index_path) # Index type without mmap support
+    docs = {}
+    index_to_docstore_id = {}
+    with open(os.path.join(path, _DOCS_FILE), "rb") as f:
+        for position, line in enumerate(f):
+            record = orjson.loads(line)
+            docs[record["id"]] = Document(page_content=record["page_content"], metadata=record["metadata"])
+            index_to_docstore_id[position] = record["id"]
+    if len(index_to_docstore_id) != index.ntotal:
+        raise ValueError(f"Docstore has {len(index_to_docstore_id)} documents but the index has {index.ntotal} vectors")
+    return FAISS(embeddings, index, InMemoryDocstore(docs), index_to_docstore_id)
+
+def _index_fingerprint(db) -> str:
+    """Identifies the indexed chunks and index type; cached retrievals are only valid for the same fingerprint."""
+    digest = hashlib.blake2b(type(db.index).__name__.encode(), digest_size=16)
+    for _, doc_id in sorted(db.index_to_docstore_id.items()):
+        digest.update(b"\0" + db.docstore.search(doc_id).page_content.encode())
+    return digest.hexdigest()
+
+def _has_unit_vectors(db) -> bool:
+    """True if the stored embeddings are L2-normalized (checked on the first vector)."""
+    if db.index.ntotal == 0:
+        return True
+    try:
+        vec = db.index.reconstruct(0)
+    except RuntimeError:
+        return True # Index type without reconstruction; nothing to check
+    return abs(float((vec ** 2).sum()) - 1.0) < 1e-3
 
 class RAGProcessor:
     def __init__(self, norms_dir: str = config.NORMS_DIR, vector_store_path: str = config.VECTOR_STORE_PATH):
         self.norms_dir = norms_dir
         self.vector_store_path = vector_store_path
         self.embeddings = self._get_embedding_model()
-        self.vector_store = self._load_or_create_vector_store()
+        # Exact-match retrievals persisted across scans, keyed by content hash (e.g. identical boilerplate files)
+        self.retrieval_cache = diskcache.Cache(config.RAG_CACHE_DIR)
+        self._set_vector_store(self._load_or_create_vector_store())
+        # Similar files (same module family, similar imports) usually retrieve the same norms
+        embedding_dim = len(self.embeddings.embed_query("dimension probe"))
+        self.norms_cache = SemanticCache(dim=embedding_dim, threshold=config.RAG_CACHE_SIMILARITY)
+        # One BatchEmbedder per event loop (each scan runs its own loop); removed by aclose_batcher.
+        # Not weakly keyed: the batcher's task references its loop, so the key would never be collected
+        self._batchers = {}
+        self._batchers_lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    @property
+    def vector_store(self):
+        return self._store[0]
+
+    def _set_vector_store(self, vector_store):
+        # Store and fingerprint are swapped together, so a retrieval never pairs an index with another one's key
+        self._store = (vector_store, _index_fingerprint(vector_store) if vector_store is not None else None)
 
     def _get_embedding_model(self):
         """Initializes the embedding model."""
         # Example: Using Sentence Transformers (works locally)
-        logging.info(f"Initializing embedding model: {config.EMBEDDING_MODEL_NAME}")
-        # Specify device='cuda' if GPU is available and configured
-        model_kwargs = {'device': 'cpu'}
-        encode_kwargs = {'normalize_embeddings': False}
+        logger.info("Initializing embedding model: %s", config.EMBEDDING_MODEL_NAME)
+        device = _embedding_device()
+        logger.info("Embedding model device: %s", device)
+        model_kwargs = {'device': device}
+        if config.EMBEDDING_BACKEND == 'onnx':
+            # ONNX Runtime with an INT8-quantized export: ~2x CPU throughput and half the memory bandwidth.
+            # Requires sentence-transformers[onnx] (>= 3.2); the file must exist in the model repo or local dir.
+            logger.info("Using ONNX Runtime embedding backend with %s", config.EMBEDDING_ONNX_FILE)
+            model_kwargs['backend'] = 'onnx'
+            model_kwargs['model_kwargs'] = {'file_name': config.EMBEDDING_ONNX_FILE}
+        # Unit-length vectors make the L2 ranking of the FAISS index equal to cosine similarity
+        encode_kwargs = {'normalize_embeddings': True, 'batch_size': config.EMBEDDING_BATCH_SIZE}
         return HuggingFaceEmbeddings(
             model_name=config.EMBEDDING_MODEL_NAME,
             model_kwargs=model_kwargs,
@@ -34,52 +242,37 @@ class RAGProcessor:
         # --- OR ---
         # Example: Using OpenAI Embeddings (requires API key)
         # if config.OPENAI_API_KEY:
-        #     logging.info("Initializing OpenAI embedding model.")
+        #     logger.info("Initializing OpenAI embedding model.")
         #     return OpenAIEmbeddings(api_key=config.OPENAI_API_KEY)
         # else:
         #     raise ValueError("OpenAI API Key needed for OpenAI embeddings, but not found.")
 
     def _load_norms(self) -> list:
         """Loads documents from the norms directory."""
-        logging.info(f"Loading norms from directory: {self.norms_dir}")
-        # Use DirectoryLoader with specific loaders for file types
-        # This requires 'unstructured' and potentially 'pypandoc'/'pandoc'
-        loaders = {
-            ".txt": TextLoader,
-            ".md": UnstructuredMarkdownLoader, # Requires 'unstructured' library
-        }
-        docs = []
+        logger.info("Loading norms from directory: %s", self.norms_dir)
         if not os.path.exists(self.norms_dir):
-             logging.warning(f"Norms directory {self.norms_dir} not found. RAG will have no context.")
+             logger.warning("Norms directory %s not found. RAG will have no context.", self.norms_dir)
              return []
 
-        for ext, loader_cls in loaders.items():
-            try:
-                loader = DirectoryLoader(
-                    self.norms_dir,
-                    glob=f"**/*{ext}",
-                    loader_cls=loader_cls,
-                    show_progress=True,
-                    use_multithreading=True, # Can speed up loading
-                    silent_errors=True # Log errors but continue
-                )
-                loaded_docs = loader.load()
-                if loaded_docs:
-                    logging.info(f"Loaded {len(loaded_docs)} documents with extension {ext}")
-                    docs.extend(loaded_docs)
-                else:
-                    logging.info(f"No documents found with extension {ext}")
-            except Exception as e:
-                logging.error(f"Error loading files with extension {ext}: {e}")
+        # One directory pass for all supported extensions
+        files = sorted(str(path) for path in Path(self.norms_dir).rglob("*") if path.suffix in _NORM_LOADERS and path.is_file())
+        if len(files) < _PARALLEL_LOAD_MIN_FILES:
+            loaded = utils.IO_EXECUTOR.map(_load_one, files) # A process pool costs more than it saves here
+        else:
+            # Markdown parsing (unstructured) is CPU-bound and holds the GIL, so spread it over processes
+            # Spawned, not forked: forking this multi-threaded process can deadlock a child on a lock held at fork time
+            with ProcessPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1), mp_context=multiprocessing.get_context("spawn")) as executor:
+                loaded = list(executor.map(_load_one, files))
+        docs = [doc for file_docs in loaded for doc in file_docs]
 
-        logging.info(f"Total documents loaded: {len(docs)}")
+        logger.info("Total documents loaded: %s from %s files", len(docs), len(files))
         return docs
 
     def _create_vector_store(self):
         """Creates and saves a new vector store."""
         docs = self._load_norms()
         if not docs:
-            logging.warning("No norm documents found or loaded. Cannot create vector store.")
+            logger.warning("No norm documents found or loaded. Cannot create vector store.")
             return None
 
         text_splitter = RecursiveCharacterTextSplitter(
@@ -87,66 +280,151 @@ class RAGProcessor:
             chunk_overlap=config.CHUNK_OVERLAP
         )
         splits = text_splitter.split_documents(docs)
-        logging.info(f"Split {len(docs)} documents into {len(splits)} chunks.")
+        logger.info("Split %s documents into %s chunks.", len(docs), len(splits))
 
         if not splits:
-             logging.warning("No text chunks generated after splitting. Cannot create vector store.")
+             logger.warning("No text chunks generated after splitting. Cannot create vector store.")
              return None
 
-        logging.info(f"Creating FAISS vector store at {self.vector_store_path}...")
+        logger.info("Creating FAISS vector store at %s...", self.vector_store_path)
         try:
             db = FAISS.from_documents(splits, self.embeddings)
-            db.save_local(self.vector_store_path)
-            logging.info("Vector store created and saved successfully.")
+            db.index = _build_ann_index(db.index) # Index ids are kept, so the docstore mapping stays valid
+            _save_vector_store(db, self.vector_store_path)
+            self.retrieval_cache.clear() # Persisted retrievals of the previous index are unreachable now
+            logger.info("Vector store created and saved successfully.")
             return db
         except Exception as e:
-            logging.error(f"Failed to create or save FAISS vector store: {e}")
+            logger.error("Failed to create or save FAISS vector store: %s", e)
             return None
 
 
     def _load_or_create_vector_store(self):
         """Loads an existing vector store or creates a new one."""
-        if os.path.exists(self.vector_store_path) and os.listdir(self.vector_store_path):
-            logging.info(f"Loading existing vector store from {self.vector_store_path}")
+        if all(os.path.exists(os.path.join(self.vector_store_path, name)) for name in (_INDEX_FILE, _DOCS_FILE)):
+            logger.info("Loading existing vector store from %s", self.vector_store_path)
             try:
-                # Allow dangerous deserialization if using custom code in embeddings/docs
-                # Be cautious if the vector store comes from an untrusted source.
-                return FAISS.load_local(
-                    self.vector_store_path,
-                    self.embeddings,
-                    allow_dangerous_deserialization=True # Needed for FAISS with HuggingFaceEmbeddings
-                )
+                # Plain FAISS index + JSON docstore: nothing is unpickled, so no dangerous deserialization
+                db = _load_vector_store(self.vector_store_path, self.embeddings)
+                if not _has_unit_vectors(db):
+                    # Built before embeddings were normalized; mixing both would skew the ranking
+                    logger.warning("Vector store holds unnormalized embeddings. Recreating it.")
+                    return self._create_vector_store()
+                return db
             except Exception as e:
-                logging.error(f"Error loading vector store: {e}. Attempting to recreate.")
+                logger.error("Error loading vector store: %s. Attempting to recreate.", e)
                 # Fallback to creating a new one if loading fails
                 return self._create_vector_store()
+        elif os.path.exists(os.path.join(self.vector_store_path, "index.pkl")):
+            # Pickled stores from earlier versions are not loaded; the norms are re-indexed instead
+            logger.info("Found a legacy pickle-based vector store. Recreating it.")
+            return self._create_vector_store()
         else:
-            logging.info("No existing vector store found. Creating a new one.")
+            logger.info("No existing vector store found. Creating a new one.")
             return self._create_vector_store()
 
     def retrieve_relevant_norms(self, query_text: str, k: int = config.RAG_TOP_K) -> list[str]:
         """Retrieves relevant norm chunks based on the query text."""
-        if self.vector_store is None:
-            logging.warning("Vector store not available. Cannot retrieve norms.")
-            return []
+        return self.retrieve_relevant_norms_batch([query_text], k)[0]
+
+    def retrieve_relevant_norms_batch(self, query_texts: list[str], k: int = config.RAG_TOP_K) -> list[list[str]]:
+        """Retrieves relevant norm chunks for several queries, embedding all cache misses in one call."""
+        vector_store, fingerprint = self._store # One consistent index even if a rebuild swaps it meanwhile
+        if vector_store is None:
+            logger.warning("Vector store not available. Cannot retrieve norms.")
+            return [[] for _ in query_texts]
         try:
-            retriever = self.vector_store.as_retriever(search_kwargs={"k": k})
-            relevant_docs = retriever.invoke(query_text) # Use invoke for newer Langchain versions
-            logging.debug(f"Retrieved {len(relevant_docs)} norms for query.")
-            # Return page content of retrieved documents
-            return [doc.page_content for doc in relevant_docs]
+            # Identical content skips both embedding and search. The index fingerprint in the key keeps a retrieval
+            # that raced with a rebuild from serving old-index norms later, even after a restart
+            cache_keys = [(utils.content_hash(query_text), config.EMBEDDING_MODEL_NAME, k, fingerprint) for query_text in query_texts]
+            results = [self.retrieval_cache.get(cache_key) for cache_key in cache_keys]
+            pending = [i for i, norms in enumerate(results) if norms is None]
+            logger.debug("Exact cache hits for %s/%s RAG queries.", len(query_texts) - len(pending), len(query_texts))
+            if not pending:
+                return results
+
+            # Embed all misses at once and reuse each vector for both the cache probe and the FAISS search
+            query_embeddings = np.asarray(self.embeddings.embed_documents([query_texts[i] for i in pending]), dtype=np.float32)
+            search_rows = []
+            for row, (i, query_embedding) in enumerate(zip(pending, query_embeddings)):
+                cached = self.norms_cache.get(query_embedding)
+                if cached is not None and cached[:2] == (k, fingerprint):
+                    logger.debug("Semantic cache hit for RAG query.")
+                    # Borrowed from a similar file: kept in memory only, so the persistent exact-match
+                    # cache (and the findings cache key built from it) holds real search results only
+                    results[i] = list(cached[2])
+                else:
+                    search_rows.append(row)
+
+            if search_rows:
+                # One FAISS search for all remaining queries instead of one per query
+                _, ids = vector_store.index.search(query_embeddings[search_rows], k)
+                docstore_ids = vector_store.index_to_docstore_id
+                for row, row_ids in zip(search_rows, ids):
+                    # FAISS pads with -1 when the index holds fewer than k vectors
+                    norms = [vector_store.docstore.search(docstore_ids[idx]).page_content for idx in row_ids if idx >= 0]
+                    logger.debug("Retrieved %s norms for query.", len(norms))
+                    i = pending[row]
+                    self.norms_cache.put(query_embeddings[row], (k, fingerprint, norms))
+                    self.retrieval_cache.set(cache_keys[i], norms)
+                    results[i] = norms
+            return results
         except Exception as e:
-            logging.error(f"Error during RAG retrieval: {e}")
-            return []
+            logger.error("Error during RAG retrieval: %s", e)
+            return [[] for _ in query_texts]
+
+    async def aretrieve_relevant_norms(self, query_text: str, k: int = config.RAG_TOP_K) -> list[str]:
+        """Async retrieval; concurrent calls on the same event loop are batched together."""
+        loop = asyncio.get_running_loop()
+        with self._batchers_lock:
+            batcher = self._batchers.get(loop)
+            if batcher is None:
+                batcher = BatchEmbedder(self.retrieve_relevant_norms_batch, config.RAG_BATCH_WINDOW_MS, config.RAG_BATCH_MAX_SIZE)
+                self._batchers[loop] = batcher
+        return await batcher.retrieve(query_text, k)
+
+    async def aclose_batcher(self):
+        """Stops and drops the current event loop's batcher; call before the loop closes (end of a scan)."""
+        with self._batchers_lock:
+            batcher = self._batchers.pop(asyncio.get_running_loop(), None)
+        if batcher is not None:
+            await batcher.aclose()
 
     def rebuild_index(self):
-        """Forces reloading norms and rebuilding the vector store index."""
-        logging.info("Rebuilding RAG index...")
-        self.vector_store = self._create_vector_store()
-        logging.info("RAG index rebuild complete.")
+        """
+        Forces reloading norms and rebuilding the vector store index; the only way to change the index.
+        Retrievals keep using the old index until the new one is swapped in. Concurrent rebuilds are serialized.
+
+        Raises:
+            RuntimeError: If no index could be built; the previous index is kept.
+        """
+        with self._rebuild_lock:
+            logger.info("Rebuilding RAG index...")
+            vector_store = self._create_vector_store() # Built aside, then swapped in with one assignment
+            if vector_store is None:
+                raise RuntimeError("RAG index rebuild failed (see earlier errors). Keeping the previous index.")
+            self._set_vector_store(vector_store)
+            # Old-index entries can no longer match (keys carry the index fingerprint); drop them to free space
+            self.retrieval_cache.clear()
+            self.norms_cache.clear()
+            logger.info("RAG index rebuild complete.")
+
+_rag_processor = None
+_rag_processor_lock = threading.Lock()
+
+def get_rag_processor() -> RAGProcessor:
+    """Returns the process-wide RAGProcessor; the embedding model and index are loaded once and shared."""
+    global _rag_processor
+    # Double-checked locking: lru_cache does not stop two threads from both constructing on first use
+    if _rag_processor is None:
+        with _rag_processor_lock:
+            if _rag_processor is None:
+                _rag_processor = RAGProcessor()
+    return _rag_processor
 
 # Example usage (optional, for testing)
 if __name__ == "__main__":
+    import logging_config # Configures logging when run as a script
     # Create dummy norm files if they don't exist
     if not os.path.exists(config.NORMS_DIR) or not os.listdir(config.NORMS_DIR):
         os.makedirs(config.NORMS_DIR, exist_ok=True)
@@ -0,0 +1,107 @@
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def _lsh_signatures(vec: np.ndarray, planes: np.ndarray, bit_weights: np.ndarray) -> np.ndarray:
+    """
+    Computes the signature of `vec` in every table with one matrix product.
+    `planes` has shape (n_tables, n_planes, dim); each signature packs the projection signs into a uint64.
+    """
+    bits = (planes @ vec) > 0
+    return bits.astype(np.uint64) @ bit_weights
+
+def _best_match(keys: np.ndarray, candidate_ids: np.ndarray, vec: np.ndarray) -> tuple[int, float]:
+    """Returns (id, cosine) of the most similar candidate; keys are stored L2-normalized."""
+    sims = keys[candidate_ids] @ vec
+    best = int(np.argmax(sims))
+    return int(candidate_ids[best]), float(sims[best])
+
+class SemanticCache:
+    """
+    Thread-safe cache keyed by embedding vectors, using random-projection LSH.
+
+    A lookup returns the value of the most similar stored key whose cosine similarity
+    with the query is at least `threshold`, or None.
+    """
+
+    def __init__(self, dim: int, n_planes: int = 16, n_tables: int = 8, threshold: float = 0.95,
+                 max_entries: int = 10000, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.dim = dim
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # One set of random hyperplanes per table; each table maps a signature to entry ids
+        self._planes = rng.standard_normal((n_tables, n_planes, dim)).astype(np.float32)
+        self._bit_weights = np.left_shift(np.uint64(1), np.arange(n_planes, dtype=np.uint64))
+        self._tables = [{} for _ in range(n_tables)]
+        # Keys live in one contiguous matrix (grown by doubling) so similarity checks are a single matmul
+        self._keys = np.empty((64, dim), dtype=np.float32)
+        self._size = 0
+        self._values = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def get(self, embedding):
+        """Returns the cached value for the closest similar key, or None on a miss."""
+        vec = self._normalize(embedding)
+        signatures = _lsh_signatures(vec, self._planes, self._bit_weights)
+        with self._lock:
+            candidates = set()
+            for signature, table in zip(signatures.tolist(), self._tables):
+                candidates.update(table.get(signature, ()))
+
+            if candidates:
+                best_idx, best_sim = _best_match(self._keys, np.fromiter(candidates, dtype=np.intp), vec)
+                if best_sim >= self.threshold:
+                    self.hits += 1
+                    return self._values[best_idx]
+            self.misses += 1
+            return None
+
+    def put(self, embedding, value):
+        """Stores a value under the given embedding."""
+        vec = self._normalize(embedding)
+        signatures = _lsh_signatures(vec, self._planes, self._bit_weights)
+        with self._lock:
+            if self._size >= self.max_entries:
+                logger.info("Semantic cache reached %s entries. Clearing it.", self.max_entries)
+                self._clear_locked()
+            if self._size == len(self._keys):
+                self._keys = np.concatenate([self._keys, np.empty_like(self._keys)])
+            idx = self._size
+            self._keys[idx] = vec
+            self._size += 1
+            self._values.append(value)
+            for signature, table in zip(signatures.tolist(), self._tables):
+                table.setdefault(signature, []).append(idx)
+
+    def _clear_locked(self):
+        self._size = 0
+        self._values.clear()
+        for table in self._tables:
+            table.clear()
+
+    def clear(self):
+        """Drops all entries (e.g. after the underlying index changed)."""
+        with self._lock:
+            self._clear_locked()
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters for monitoring."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -1,37 +1,64 @@
 import os
+import atexit
 import git
 import shutil
 import logging
 import uuid
+import hashlib
+import functools
+import threading
 from pathlib import Path
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
+import tiktoken
 import config
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Shared pool for blocking file I/O (reads, norm loading), reused across scans instead of one pool per phase
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 4) * 4), thread_name_prefix="io")
+atexit.register(IO_EXECUTOR.shutdown, wait=False)
+
+# Set when the service stops; running scans check it so the process can exit without waiting for them
+SHUTDOWN = threading.Event()
 
 def generate_job_id():
     """Generates a unique job ID."""
     return str(uuid.uuid4())
 
+def content_hash(text: str) -> str:
+    """Returns a short BLAKE2b digest of a text, used as a cache key (faster than SHA-256)."""
+    return hashlib.blake2b(text.encode('utf-8', errors='ignore'), digest_size=16).hexdigest()
+
 def clone_repo(repo_url: str, job_id: str) -> str | None:
     """Clones a Git repository to a unique directory."""
     target_dir = os.path.join(config.REPO_CLONE_DIR, job_id)
     if os.path.exists(target_dir):
-        logging.warning(f"Target directory {target_dir} already exists. Removing.")
+        logger.warning("Target directory %s already exists. Removing.", target_dir)
         shutil.rmtree(target_dir)
 
-    logging.info(f"Cloning {repo_url} to {target_dir}...")
+    logger.info("Cloning %s to %s...", repo_url, target_dir)
+    # Only the HEAD working tree is analyzed: skip history, other branches, tags and old blob revisions
+    clone_options = ['--depth=1', '--filter=blob:none', '--single-branch', '--no-tags']
+    if config.CLONE_SPARSE_PATHS:
+        clone_options.append('--no-checkout') # Checked out below, limited to the sparse paths
     try:
-        git.Repo.clone_from(repo_url, target_dir)
-        logging.info(f"Successfully cloned {repo_url}")
+        repo = git.Repo.clone_from(repo_url, target_dir, multi_options=clone_options)
+        if config.CLONE_SPARSE_PATHS:
+            repo.git.sparse_checkout('init', '--cone')
+            repo.git.sparse_checkout('set', *config.CLONE_SPARSE_PATHS)
+            repo.git.checkout()
+            logger.info("Checked out only %s", config.CLONE_SPARSE_PATHS)
+        logger.info("Successfully cloned %s", repo_url)
         return target_dir
     except git.GitCommandError as e:
-        logging.error(f"Error cloning repository {repo_url}: {e}")
+        logger.error("Error cloning repository %s: %s", repo_url, e)
         # Clean up failed clone attempt
         if os.path.exists(target_dir):
             shutil.rmtree(target_dir)
         return None
     except Exception as e:
-        logging.error(f"An unexpected error occurred during cloning: {e}")
+        logger.error("An unexpected error occurred during cloning: %s", e)
         if os.path.exists(target_dir):
             shutil.rmtree(target_dir)
         return None
@@ -40,49 +67,102 @@ def clone_repo(repo_url: str, job_id: str) -> str | None:
 def cleanup_repo(repo_path: str):
     """Removes the cloned repository directory."""
     if repo_path and os.path.exists(repo_path):
-        logging.info(f"Cleaning up repository at {repo_path}")
+        logger.info("Cleaning up repository at %s", repo_path)
         try:
             shutil.rmtree(repo_path)
         except OSError as e:
-            logging.error(f"Error removing directory {repo_path}: {e}")
+            logger.error("Error removing directory %s: %s", repo_path, e)
+        # Memoized reads are keyed by clone paths (which contain the job ID), so they never hit
+        # in a later scan; drop them rather than pinning deleted files' contents
+        _read_small_file.cache_clear()
     else:
-        logging.warning(f"Attempted to clean up non-existent path: {repo_path}")
+        logger.warning("Attempted to clean up non-existent path: %s", repo_path)
 
 
 def find_code_files(repo_path: str) -> list[str]:
     """Finds all files matching allowed extensions in the repo."""
     code_files = []
-    allowed_exts = tuple(config.ALLOWED_EXTENSIONS)
-    logging.info(f"Scanning for files with extensions: {allowed_exts} in {repo_path}")
+    allowed_exts = frozenset(ext.strip().lower() for ext in config.ALLOWED_EXTENSIONS)
+    logger.info("Scanning for files with extensions: %s in %s", sorted(allowed_exts), repo_path)
 
     if not os.path.isdir(repo_path):
-        logging.error(f"Repository path {repo_path} does not exist or is not a directory.")
+        logger.error("Repository path %s does not exist or is not a directory.", repo_path)
         return []
 
-    for root, _, files in os.walk(repo_path):
-        # Skip .git directory
-        if '.git' in root.split(os.sep):
-            continue
-        for file in files:
-            if file.lower().endswith(allowed_exts):
-                full_path = os.path.join(root, file)
-                # Convert to relative path for cleaner reporting
-                relative_path = os.path.relpath(full_path, repo_path)
-                code_files.append(relative_path) # Store relative path
-
-    logging.info(f"Found {len(code_files)} code files.")
+    # Iterative scandir: DirEntry caches the file type, so no extra stat call per entry
+    stack = [repo_path]
+    while stack:
+        current_dir = stack.pop()
+        try:
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        # Prune excluded (VCS, vendored, generated) directories so they are never descended into
+                        if entry.name not in config.EXCLUDED_DIRS:
+                            stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in allowed_exts:
+                        # Convert to relative path for cleaner reporting
+                        code_files.append(os.path.relpath(entry.path, repo_path)) # Store relative path
+        except OSError as e:
+            logger.warning("Skipping unreadable directory %s: %s", current_dir, e)
+
+    logger.info("Found %s code files.", len(code_files))
     return code_files
 
-def read_file_content(repo_base_path: str, relative_file_path: str) -> str | None:
-    """Reads the content of a specific file."""
-    full_path = os.path.join(repo_base_path, relative_file_path)
+# Files up to this size are memoized: a scan reads each file several times (size check, batch packing, analysis)
+_MEMO_MAX_BYTES = 64 * 1024
+
+@functools.lru_cache(maxsize=1024)
+def _read_small_file(full_path: str, mtime_ns: int) -> bytes:
+    # mtime_ns is part of the cache key, so a modified file is read again
+    return Path(full_path).read_bytes()
+
+def read_file_content(repo_base_path: str, relative_file_path: str, max_bytes: int | None = None) -> str | None:
+    """
+    Reads the content of a specific file, optionally only its first `max_bytes` bytes.
+    Returns None for files larger than MAX_SCAN_FILE_BYTES, which are never analyzed.
+    """
+    path = Path(repo_base_path, relative_file_path)
     try:
-        with open(full_path, 'r', encoding='utf-8', errors='ignore') as f:
-            return f.read()
+        stat = path.stat()
+        if stat.st_size > config.MAX_SCAN_FILE_BYTES:
+            logger.warning("Not reading %s: %s bytes exceeds MAX_SCAN_FILE_BYTES.", path, stat.st_size)
+            return None
+        # Raw bytes are cached and sliced before decoding, so max_bytes counts bytes on both paths
+        data = _read_small_file(str(path), stat.st_mtime_ns) if stat.st_size <= _MEMO_MAX_BYTES else path.read_bytes()
+        return (data[:max_bytes] if max_bytes else data).decode('utf-8', errors='ignore')
     except FileNotFoundError:
-        logging.error(f"File not found: {full_path}")
+        logger.error("File not found: %s", path)
         return None
     except Exception as e:
-        logging.error(f"Error reading file {full_path}: {e}")
+        logger.error("Error reading file %s: %s", path, e)
         return None
 
+
+def read_files_bulk(repo_base_path: str, relative_file_paths: list[str], max_bytes: int | None = None) -> dict[str, str | None]:
+    """Reads several files concurrently on IO_EXECUTOR; maps each path to its content (None if unreadable)."""
+    contents = IO_EXECUTOR.map(read_file_content, repeat(repo_base_path), relative_file_paths, repeat(max_bytes))
+    return dict(zip(relative_file_paths, contents))
+
+
+@functools.lru_cache(maxsize=1)
+def _get_token_encoding():
+    """
+    Returns the tiktoken encoding for the configured OpenAI model (cl100k_base for unknown models),
+    or None when it cannot be loaded: tiktoken downloads the BPE file on first use, which fails offline.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(config.OPENAI_MODEL_NAME)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("Could not load the tiktoken encoding (%s). Estimating tokens from text length.", e)
+        return None # Cached too, so the download is not retried on every call
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the number of LLM tokens in a text (exact for OpenAI models, approximate otherwise)."""
+    encoding = _get_token_encoding()
+    if encoding is None:
+        return len(text) // 4 # Roughly 4 characters per token for English text and code
+    return len(encoding.encode(text, disallowed_special=()))
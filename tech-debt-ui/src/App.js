@@ -96,7 +96,17 @@ function App() {
     setRagStatus('Rebuilding index...');
     try {
       const response = await api.post('/rag/rebuild');
-      setRagStatus(response.data?.message || 'RAG index rebuild successful!');
+      const jobId = response.data?.job_id;
+      // The rebuild runs in the background; poll its job until it finishes
+      let job = response.data;
+      while (jobId && ['PENDING', 'RUNNING'].includes(job?.status)) {
+        await new Promise(resolve => setTimeout(resolve, POLLING_INTERVAL));
+        job = (await api.get(`/status/${jobId}`)).data;
+      }
+      if (job?.status === 'FAILED') {
+        throw new Error(job.error || 'Failed to rebuild RAG index.');
+      }
+      setRagStatus(job?.message || 'RAG index rebuild successful!');
     } catch (err) {
       console.error("RAG rebuild failed:", err);
       const errorMsg = err.response?.data?.error || err.message || 'Failed to rebuild RAG index.';